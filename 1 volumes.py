@@ -1,84 +1,167 @@
 import os
-import shutil
+import time
 from glob import glob
-from multiprocessing import Pool
 
+import numpy as np
 import pandas as pd
+import xarray as xr
 from natsort import natsorted
 
 import river_route as rr
 
+from catchment_volumes import build_stacked_weights, calc_catchment_volumes
+from manifest import jobs_in_state, record, record_many, stage_is_empty
+from scheduler import cost_model, parquet_rows, run_jobs
+
 configs_root = '/home/ubuntu/routing_configs'
 volumes_root = '/mnt/volumes'
 runoffs_root = '/mnt/era5'
+months_per_job = 120  # runoff files processed by a worker for the same vpu before it picks up a new job
+mode = 'runoff-major'  # 'vpu-major': jobs are (vpu, months), 'runoff-major': each job reads one month for all vpus
+hours_per_read = 48  # runoff-major: timesteps of the global ro grid decoded at once
+rivers_per_product = 500_000  # runoff-major: rows of the stacked weights multiplied at once (bounds memory)
+stacked_weights = None  # runoff-major: built by the main process for the workers (see scheduler.fork)
+ram_budget_mb = 700_000  # estimated peak memory of the running jobs is kept under this
+completed_volumes = set()  # {vpu}/{YYYYMM} jobs done according to the manifest
+
+
+def compute_volumes_all_vpus(runoff_file):
+    configs_dirs, river_ids, grid_cells, matrix, offsets = stacked_weights
+    todo = [not output_file_exists(c, runoff_file) for c in configs_dirs]
+    started = time.time()
+
+    try:
+        # decode the month once, keeping only the cells used by at least one vpu
+        with xr.open_dataset(runoff_file) as ds:
+            times = pd.to_datetime(ds['valid_time'].values)
+            depths = np.empty((times.shape[0], grid_cells.shape[0]), dtype=np.float32)
+            for t in range(0, times.shape[0], hours_per_read):
+                block = ds['ro'].isel(valid_time=slice(t, t + hours_per_read)).values
+                depths[t:t + block.shape[0]] = block.reshape(block.shape[0], -1)[:, grid_cells]
+        depths = np.nan_to_num(depths, nan=0)
+        depths[depths < 0] = 0  # force positive runoff
+
+        # multiply the stacked weights by the month of depths in groups of consecutive vpus, then split by vpu
+        first = 0
+        while first < len(configs_dirs):
+            last = first
+            while last + 1 < len(configs_dirs) and offsets[last + 2] - offsets[first] <= rivers_per_product:
+                last += 1
+            if any(todo[first:last + 1]):
+                volumes = matrix[offsets[first]:offsets[last + 1]].dot(depths.T).T
+                for i in range(first, last + 1):
+                    if not todo[i]:
+                        continue
+                    volumes_dir = os.path.join(volumes_root, os.path.basename(configs_dirs[i]))
+                    os.makedirs(volumes_dir, exist_ok=True)
+                    rr.runoff.write_catchment_volumes(
+                        pd.DataFrame(
+                            volumes[:, offsets[i] - offsets[first]:offsets[i + 1] - offsets[first]],
+                            index=times,
+                            columns=river_ids[i],
+                        ),
+                        output_dir=volumes_dir,
+                    )
+                    # the decode is counted in the first vpu's time so the month's times sum to the job's wall time
+                    record_volumes(configs_dirs[i], runoff_file, time.time() - started)
+                    started = time.time()
+            first = last + 1
+        print(f'Job done for {runoff_file}')
+    except Exception as e:
+        # printed for the console and raised so the job is logged as failed
+        print(f'Error in {runoff_file}: {e}')
+        raise
+    return
 
 
 def compute_volumes(arg):
     configs = arg[0]
-    runoff_file = arg[1]
-    weight_table_name = f'gridweights_ERA5_{os.path.basename(configs)}.nc'
+    runoff_files = arg[1]
     volumes_dir = os.path.join(volumes_root, os.path.basename(configs))
     os.makedirs(volumes_dir, exist_ok=True)
 
-    try:
-        rr.runoff.write_catchment_volumes(
-            rr.runoff.calc_catchment_volumes(
-                runoff_data=runoff_file,
-                weight_table=os.path.join(configs, weight_table_name),
-                runoff_var='ro',
-                x_var='longitude',
-                y_var='latitude',
-                river_id_var='river_id',
-                time_var='valid_time',
-                cumulative=False,
-                force_positive_runoff=True,
-                force_uniform_timesteps=False,
-            ),
-            output_dir=volumes_dir,
-        )
-        print(f'Job done for {configs} and {runoff_file}')
-    except Exception as e:
-        print(f'Error in {configs} and {runoff_file}: {e}')
+    failed = []
+    for runoff_file in runoff_files:
+        try:
+            started = time.time()
+            rr.runoff.write_catchment_volumes(calc_catchment_volumes(configs, runoff_file), output_dir=volumes_dir)
+            record_volumes(configs, runoff_file, time.time() - started)
+            print(f'Job done for {configs} and {runoff_file}')
+        except Exception as e:
+            print(f'Error in {configs} and {runoff_file}: {e}')
+            failed.append(os.path.basename(runoff_file))
+    # the remaining months are still processed, then the job is logged as failed
+    if failed:
+        raise RuntimeError(f'{len(failed)} runoff files failed for {configs}: {failed}')
     return
 
 
-if __name__ == '__main__':
-    n_configs_duplicates = 20
-    all_configs = [f'routing_configs_{n + 1}' for n in range(n_configs_duplicates)]
-    print(f'duplicating configs root')
-    for c in all_configs:
-        if not os.path.exists(f'/home/ubuntu/{c}'):
-            shutil.copytree(configs_root, f'/home/ubuntu/{c}')
-
-    # Collect configs from all duplicates
-    configs_dirs = natsorted(glob(os.path.join(configs_root, '*')))
-    configs_dirs = [d for d in configs_dirs if os.path.isdir(d)]
-    # sort the configs dirs large to small by the number of rows in configs/routing_parameters.parquet
-    configs_dirs = sorted(configs_dirs,key=lambda x: -pd.read_parquet(os.path.join(x, 'routing_parameters.parquet')).shape[0])
-    runoff_files = natsorted(glob(os.path.join(runoffs_root, 'year=*/*.nc')))
+def volumes_job(configs, runoff_file) -> str:
+    return f'{os.path.basename(configs)}/{os.path.basename(runoff_file).split("_")[1].split(".")[0]}'
+
 
-    # make all permutations of configs_dirs and runoff_files
-    jobs = [[c, r] for c in configs_dirs for r in runoff_files]  # sequential by runoff file date then by vpu dir
+def volumes_files(configs, runoff_file) -> list:
+    # {volumes_root}/{vpu}/volumes_{runoff_file_name}*.nc
+    file_name = f'volumes_{os.path.basename(runoff_file).split("_")[1].split(".")[0]}*.nc'
+    return glob(os.path.join(volumes_root, os.path.basename(configs), file_name))
 
 
-    # check for completed files at {volumes_root}/{vpu}/volumes_{runoff_file_name}*.nc
-    def output_file_exists(arg):
-        file_name = f'volumes_{os.path.basename(arg[1]).split('_')[1].split('.')[0]}*.nc'
-        file_path = os.path.join(volumes_root, os.path.basename(arg[0]), file_name)
-        return len(glob(file_path)) > 0
+def record_volumes(configs, runoff_file, seconds) -> None:
+    record('volumes', volumes_job(configs, runoff_file), outputs=volumes_files(configs, runoff_file), seconds=seconds,
+           checksum=True)
 
 
-    jobs = [j for j in jobs if not output_file_exists(j)]
-    print(f'Jobs to complete: {len(jobs)}')
+def output_file_exists(configs, runoff_file):
+    return volumes_job(configs, runoff_file) in completed_volumes
 
-    # edit the jobs to use sequentially repeating configs dir duplicates to reduce competition for file IO
-    jobs = [
-        [c.replace('routing_configs', all_configs[i % n_configs_duplicates]), r]
-        for i, (c, r) in enumerate(jobs)
-    ]
 
-    # Process jobs in parallel
-    with Pool(92) as p:
-        [p.apply_async(compute_volumes, args=(job,)) for job in jobs]
-        p.close()
-        p.join()
+def seed_manifest() -> None:
+    # volumes written before the manifest existed are found with one glob instead of one per job
+    existing = glob(os.path.join(volumes_root, '*', 'volumes_*.nc'))
+    record_many('volumes', [
+        (f'{os.path.basename(os.path.dirname(f))}/{os.path.basename(f).split("_")[1][:6]}', [f, ]) for f in existing
+    ])
+
+
+if __name__ == '__main__':
+    configs_dirs = natsorted(glob(os.path.join(configs_root, '*')))
+    configs_dirs = [d for d in configs_dirs if os.path.isdir(d)]
+    n_rivers = {c: parquet_rows(c) for c in configs_dirs}
+    runoff_files = natsorted(glob(os.path.join(runoffs_root, 'year=*/*.nc')))
+    if stage_is_empty('volumes'):
+        seed_manifest()
+    completed_volumes = jobs_in_state('volumes')
+
+    if mode == 'runoff-major':
+        jobs = [r for r in runoff_files if not all(output_file_exists(c, r) for c in configs_dirs)]
+        print(f'Jobs to complete: {len(jobs)} runoff files')
+        with xr.open_dataset(runoff_files[0]) as ds:
+            n_lon = ds['longitude'].shape[0]
+        print('stacking weight tables')
+        stacked_weights = build_stacked_weights(configs_dirs, n_lon)
+        # each worker holds a month of depths for every used cell plus one product block of at most
+        # rivers_per_product rivers, so the memory budget rather than the core count limits the workers
+        total_rivers = sum(n_rivers.values())
+        run_jobs(
+            compute_volumes_all_vpus, jobs, 'volumes-runoff-major', names=jobs, units=[total_rivers] * len(jobs),
+            memory_units=[min(total_rivers, rivers_per_product)] * len(jobs),
+            cost=cost_model('volumes-runoff-major', 2e-6, 1e-2, base_mb=8_000),
+            n_workers=92, ram_budget_mb=ram_budget_mb,
+        )
+    else:
+        # group the runoff files by vpu so each worker reuses the same weight table for many months
+        jobs = []
+        for c in configs_dirs:
+            todo = [r for r in runoff_files if not output_file_exists(c, r)]
+            jobs += [[c, todo[i:i + months_per_job]] for i in range(0, len(todo), months_per_job)]
+        print(f'Jobs to complete: {len(jobs)} ({sum(len(j[1]) for j in jobs)} runoff files)')
+
+        # Process jobs in parallel, largest vpus first
+        run_jobs(
+            compute_volumes, jobs, 'volumes-vpu-major',
+            names=[f'{os.path.basename(c)} {len(months)} months' for c, months in jobs],
+            units=[n_rivers[c] * len(months) for c, months in jobs],
+            memory_units=[n_rivers[c] for c, _ in jobs],  # one month of the vpu is held at a time
+            cost=cost_model('volumes-vpu-major', 2e-6, 1e-2),
+            n_workers=92, ram_budget_mb=ram_budget_mb, maxtasksperchild=4,
+        )
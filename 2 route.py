@@ -1,120 +1,415 @@
 import os
+import time
 from glob import glob
-from multiprocessing import Pool
 
 import netCDF4 as nc
+import numpy as np
 import pandas as pd
+import xarray as xr
 from natsort import natsorted
 
 import river_route as rr
 
+from catchment_volumes import calc_catchment_volumes
+from instrument import instrumented
+from manifest import is_done, jobs_in_state, record, record_many, stage_is_empty
+from muskingum import read_operators, read_state, route_blocks, route_blocks_split, write_state
+from scheduler import cost_model, fork, parquet_rows, run_jobs
+from zarr_stores import create_store, discharge_attrs, extend_time, open_variable
+
 configs_root = '/home/ubuntu/routing_configs'
 volumes_root = '/mnt/volumes'
+runoffs_root = '/mnt/era5'
 discharge_root = '/mnt/discharge/MAXES'
-os.makedirs(discharge_root, exist_ok=True)
+zarr_root = '/mnt/zarr/hourly'
+maxima_root = '/mnt/zarr/maxima'
+pipeline = 'files'  # 'files': route the volumes_*.nc from 1 volumes.py, 'fused': compute volumes while routing
+outflow_products = ['monmax', 'annmax']  # any of 'hourly', 'daily', 'monthly', 'monmax', 'annmax' from one routing run
+outflow_format = 'netcdf'  # 'zarr': write the hourly product into {zarr_root}/{vpu}.zarr instead of monthly netcdfs
+hourly_times = pd.date_range('1940-01-01 00:00', '2024-12-31 23:00', freq='h')  # time axis of the hourly zarrs
+hourly_chunks = {'time': 8784, 'river_id': 500}
+maxima_chunks = {'time': 1, 'river_id': 100_000}  # one row per chunk, so flushing a year writes only that year
+# 'stream' (recommended): route the files pipeline month by month with muskingum.py like the fused pipeline, loading
+# each vpu's operators from its cached npz (see muskingum.read_operators). 'river-route': rr.Muskingum, which rebuilds
+# the operators from the parquet files for every decade
+engine = 'stream'
+outflow_scratch_dir = None  # stream: memory map each vpu's one month outflow buffer to a file in this directory
+split_rivers = 1_000_000  # vpus with more rivers are split into pieces routed in parallel, one vpu at a time
+workers_per_vpu = 32  # processes routing the pieces of a split vpu
+append = False  # route only the volumes after the latest finalstate_*.parquet (new ERA5 months)
+parareal = False  # route all decades of a vpu at once from estimated initial states, then correct them in order
+spinup_months = 12  # parareal: months before a decade routed from rest to estimate the decade's initial state
+parareal_rtol = 1e-4  # parareal: tolerance of a state against the serial chain, relative to the discharge
+parareal_atol = 1e-3  # parareal: and absolute, in m3 s-1
+ram_budget_mb = 700_000  # estimated peak memory of the running routing jobs is kept under this
+annual_maxima = {}  # annmax: vpu -> (year, running maximum of each river, months seen), flushed to {maxima_root}
+
+
+def file_month(file) -> str:
+    # era5 runoff and volumes file names start with {prefix}_{YYYYMM}
+    return os.path.basename(file).split('_')[1][:6]
+
+
+def aggregate_outflows(df: pd.DataFrame, products: list) -> dict:
+    """
+    Compute the requested aggregations of a routed (time x river_id) DataFrame in one pass over its numpy array.
+    Timesteps are grouped by integer day and month numbers (datetime64[D] and [M]) with reduceat over the sorted
+    index. Returns {product: (times, values, aggregation_method)}.
+    """
+    times = df.index.values
+    values = df.values
+    outputs = {}
+    groups = {}  # period -> (first row of each period, period start times, rows per period)
+    if 'hourly' in products:
+        outputs['hourly'] = (df.index, values, 'mean')
+    for product, period in (('daily', 'D'), ('monthly', 'M'), ('monmax', 'M')):
+        if product not in products:
+            continue
+        if period not in groups:
+            periods = times.astype(f'datetime64[{period}]').astype(np.int64)
+            starts = np.flatnonzero(np.r_[True, periods[1:] != periods[:-1]])
+            counts = np.diff(np.r_[starts, periods.shape[0]]).reshape(-1, 1)
+            groups[period] = (starts, pd.DatetimeIndex(times[starts].astype(f'datetime64[{period}]')), counts)
+        starts, period_times, counts = groups[period]
+        if product == 'monmax':
+            outputs[product] = (period_times, np.maximum.reduceat(values, starts, axis=0), 'max')
+        else:
+            sums = np.add.reduceat(values, starts, axis=0, dtype=np.float64)
+            outputs[product] = (period_times, sums / counts, 'mean')
+    return outputs
+
+
+def write_outflow_netcdf(file: str, times: pd.DatetimeIndex, river_ids, values, aggregation_method: str) -> None:
+    with nc.Dataset(file, mode='w', format='NETCDF4') as ds:
+        ds.createDimension('time', size=values.shape[0])
+        ds.createDimension('river_id', size=values.shape[1])
+        time_var = ds.createVariable('time', 'f8', ('time',))
+        time_var.units = f'seconds since {times[0].strftime("%Y-%m-%d %H:%M:%S")}'
+        time_var[:] = (times - times[0]).total_seconds().values
+        id_var = ds.createVariable('river_id', 'i4', ('river_id',), )
+        id_var[:] = river_ids
+        flow_var = ds.createVariable('Q', 'f4', ('time', 'river_id'), zlib=True, complevel=3)
+        flow_var[:] = values
+        flow_var.long_name = 'Discharge at catchment outlet'
+        flow_var.standard_name = 'discharge'
+        flow_var.aggregation_method = aggregation_method
+        flow_var.units = 'm3 s-1'
+
+
+def create_hourly_zarr(vpu: str, river_ids) -> None:
+    create_store(
+        f'{zarr_root}/{vpu}.zarr',
+        dims=('time', 'river_id'),
+        coords={'time': hourly_times, 'river_id': river_ids},
+        chunks=hourly_chunks,
+        var_attrs={**discharge_attrs, 'aggregation_method': 'mean'},
+    )
+
+
+def write_hourly_zarr(df: pd.DataFrame, vpu: str) -> None:
+    # the month's rows are located on the preallocated time axis by integer hour offsets
+    path = f'{zarr_root}/{vpu}.zarr'
+    first = (df.index[0] - hourly_times[0]) // pd.Timedelta(hours=1)
+    if first < 0:
+        raise ValueError(f'{vpu} outflows {df.index[0]} to {df.index[-1]} are before the hourly zarr time axis')
+    n_times = open_variable(path, mode='r').shape[0]
+    if first + df.shape[0] > n_times:
+        # months appended after the original record extend the time axis
+        extend_time(path, df.index[max(0, n_times - first):])
+    open_variable(path)[first:first + df.shape[0], :] = df.values.astype('float32')
+
+
+def create_maxima_zarr(vpu: str, river_ids) -> None:
+    create_store(
+        f'{maxima_root}/{vpu}.zarr',
+        dims=('time', 'river_id'),
+        coords={'time': pd.date_range(hourly_times[0], hourly_times[-1], freq='YS'), 'river_id': river_ids},
+        chunks=maxima_chunks,
+        var_attrs={**discharge_attrs, 'aggregation_method': 'max'},
+    )
+
+
+def maxima_row(vpu: str, year: int) -> int:
+    # the row of a year in the vpu's maxima store, extending the store through that year if needed
+    path = f'{maxima_root}/{vpu}.zarr'
+    row = year - hourly_times[0].year
+    n_years = open_variable(path, mode='r').shape[0]
+    if row >= n_years:
+        extend_time(path, pd.date_range(f'{hourly_times[0].year + n_years}-01-01', f'{year}-01-01', freq='YS'))
+    return row
+
+
+def flush_annual_max(vpu: str) -> None:
+    # a whole year replaces its row (years routed again overwrite the old values). part of a year is combined with the
+    # row already in the store so a year routed in several runs (appended months) keeps its maximum.
+    if vpu not in annual_maxima:
+        return
+    year, values, n_months = annual_maxima.pop(vpu)
+    row = maxima_row(vpu, year)
+    array = open_variable(f'{maxima_root}/{vpu}.zarr')
+    array[row, :] = values if n_months == 12 else np.fmax(array[row, :], values)
+
+
+def accumulate_annual_max(df: pd.DataFrame, vpu: str) -> None:
+    """
+    Fold a month of outflows into the running maximum of its year and flush the year to the vpu's maxima store once
+    December has been routed. Partial years are flushed by route when the run ends.
+    """
+    year = df.index[0].year
+    if vpu in annual_maxima and annual_maxima[vpu][0] != year:
+        flush_annual_max(vpu)
+    month_max = df.values.max(axis=0).astype('float32')
+    if vpu in annual_maxima:
+        annual_maxima[vpu] = (year, np.fmax(annual_maxima[vpu][1], month_max), annual_maxima[vpu][2] + 1)
+    else:
+        annual_maxima[vpu] = (year, month_max, 1)
+    if df.index[-1].month == 12:
+        flush_annual_max(vpu)
+
+
+def custom_write_outflows(df: pd.DataFrame, outflow_file: str, runoff_file: str) -> None:
+    products = outflow_products
+    if 'annmax' in products:
+        accumulate_annual_max(df, os.path.basename(os.path.dirname(outflow_file)))
+        products = [p for p in products if p != 'annmax']
+    if outflow_format == 'zarr' and 'hourly' in products:
+        write_hourly_zarr(df, os.path.basename(os.path.dirname(outflow_file)))
+        products = [p for p in products if p != 'hourly']
+    for product, (times, values, method) in aggregate_outflows(df, products).items():
+        write_outflow_netcdf(outflow_file.replace('Q_', f'Q_{product}_'), times, df.columns.values, values, method)
+    return
+
 
+def read_volumes(volumes_file) -> pd.DataFrame:
+    with xr.open_dataset(volumes_file) as ds:
+        return ds['volume'].transpose('time', 'river_id').to_pandas()
 
-def route(configs):
+
+def list_monthly_inputs(vpu) -> list:
+    # one file per month: the era5 runoff for the fused pipeline, otherwise the volumes from 1 volumes.py
+    if pipeline == 'fused':
+        return natsorted(glob(os.path.join(runoffs_root, 'year=*/*.nc')))
+    return natsorted(glob(os.path.join(volumes_root, vpu, 'volumes_*.nc')))
+
+
+def read_monthly_volumes(configs, monthly_input) -> pd.DataFrame:
+    if pipeline == 'fused':
+        return calc_catchment_volumes(configs, monthly_input)
+    return read_volumes(monthly_input)
+
+
+def monthly_outflow_file(vpu, monthly_input) -> str:
+    if pipeline == 'fused':
+        return os.path.join(discharge_root, vpu, f'Q_{file_month(monthly_input)}.nc')
+    return os.path.join(discharge_root, vpu, os.path.basename(monthly_input).replace('volumes', 'Q'))
+
+
+def contiguous_months(monthly_inputs, first_month) -> list:
+    # the inputs from first_month (a pd.Period) up to the first missing month, so routing never steps over a gap
+    expected = pd.period_range(first_month, periods=len(monthly_inputs), freq='M').strftime('%Y%m')
+    contiguous = []
+    for monthly_input, month in zip(monthly_inputs, expected):
+        if file_month(monthly_input) != month:
+            break
+        contiguous.append(monthly_input)
+    return contiguous
+
+
+def route_stream(configs, params_file, connectivity_file, write_outflows, n_workers=1) -> None:
+    """
+    Route month by month with the matrix Muskingum in muskingum.py, computing the volumes on the fly (fused pipeline)
+    or reading the volumes_*.nc files. With n_workers > 1 the vpu is split into pieces routed in parallel. The routing
+    state is saved at each decade boundary (and at the end of the record) with the same finalstate_*.parquet names as
+    the decade runs, and a restarted run resumes from the latest one. Only one month of volumes and float32 outflows
+    is held at a time. Routing stops before the first missing month and resumes there once its input exists.
+    """
+    vpu = os.path.basename(configs)
+    monthly_inputs = list_monthly_inputs(vpu)
+    checkpoints = natsorted(glob(f'{discharge_root}/{vpu}/finalstate_*.parquet'))
+    initial_state_file = checkpoints[-1] if checkpoints else ''
+    first_month = pd.Period(hourly_times[0], freq='M')
+    if initial_state_file:
+        resume_after = os.path.basename(initial_state_file).split('_')[1][:6]
+        monthly_inputs = [f for f in monthly_inputs if file_month(f) > resume_after]
+        first_month = pd.Period(f'{resume_after[:4]}-{resume_after[4:]}', freq='M') + 1
+    available = monthly_inputs
+    monthly_inputs = contiguous_months(monthly_inputs, first_month)
+    if len(monthly_inputs) < len(available):
+        print(f'{vpu}: input for {first_month + len(monthly_inputs)} is missing, routing stops before it')
+    if not monthly_inputs:
+        print(f'Skipping {vpu}: no contiguous inputs after {initial_state_file or "the start of the record"}')
+        return
+
+    print(f'Routing {vpu} from {file_month(monthly_inputs[0])} to {file_month(monthly_inputs[-1])}')
+    network, operators = read_operators(params_file, connectivity_file)
+    q, r = read_state(initial_state_file, network[0].shape[0])
+    volumes = (read_monthly_volumes(configs, f) for f in monthly_inputs)
+    scratch_file = os.path.join(outflow_scratch_dir, f'{vpu}.f32') if outflow_scratch_dir else None
+    if n_workers > 1:
+        routed = route_blocks_split(network, volumes, q, r, 3600, n_workers, scratch_file)
+    else:
+        routed = route_blocks(network, volumes, q, r, 3600, operators, scratch_file)
+    started = time.time()
+    try:
+        for monthly_input, (outflows, q, r) in zip(monthly_inputs, routed):
+            month = file_month(monthly_input)
+            write_outflows(outflows, monthly_outflow_file(vpu, monthly_input), monthly_input)
+            if (month[3] == '9' and month[4:] == '12') or monthly_input == monthly_inputs[-1]:
+                state_file = f'{discharge_root}/{vpu}/finalstate_{outflows.index[-1].strftime("%Y%m%d%H%M")}.parquet'
+                write_state(state_file, q, r)
+                record_state(state_file, time.time() - started)
+                started = time.time()
+                print(f'Finished routing {vpu} through {month}')
+    finally:
+        routed.close()  # releases the memory map before its file is deleted
+        if scratch_file is not None and os.path.exists(scratch_file):
+            os.remove(scratch_file)
+
+
+def route(configs, n_workers=1):
     vpu = os.path.basename(configs)
     params_file = f'{configs}/routing_parameters.parquet'
     params_modified = f'{configs}/routing_parameters_faster.parquet'
     connectivity_file = f'{configs}/connectivity.parquet'
+    prepare_outputs(configs)
+
+    if pipeline == 'fused' or engine == 'stream' or n_workers > 1:
+        # resumes from the latest checkpoint, so new months are appended the same way
+        route_stream(configs, params_modified, connectivity_file, custom_write_outflows, n_workers)
+    elif append:
+        route_append(vpu, params_modified, connectivity_file)
+    else:
+        route_decades(vpu, params_modified, connectivity_file)
+    flush_annual_max(vpu)
+    mark_zarr_complete(vpu)
+
+
+def route_split(configs_dirs) -> None:
+    # the split vpus one at a time, each on workers_per_vpu processes. started as its own (non-daemonic) process so it
+    # can start pools while the main process routes the other vpus
+    for configs in configs_dirs:
+        try:
+            route(configs, n_workers=workers_per_vpu)
+        except Exception as e:
+            print(f'route {os.path.basename(configs)} failed: {e}')
+
+
+def prepare_outputs(configs) -> None:
+    vpu = os.path.basename(configs)
+    params_modified = f'{configs}/routing_parameters_faster.parquet'
     os.makedirs(f'{discharge_root}/{vpu}', exist_ok=True)
+    if outflow_format == 'zarr' and 'hourly' in outflow_products and not os.path.exists(f'{zarr_root}/{vpu}.zarr'):
+        create_hourly_zarr(vpu, pd.read_parquet(params_modified, columns=['river_id'])['river_id'].values)
+    if 'annmax' in outflow_products and not os.path.exists(f'{maxima_root}/{vpu}.zarr'):
+        create_maxima_zarr(vpu, pd.read_parquet(params_modified, columns=['river_id'])['river_id'].values)
+
+
+def mark_zarr_complete(vpu) -> None:
+    # the hourly zarr replaces the netcdf to zarr conversion in 3 hourly.py once the last decade is routed
+    if outflow_format == 'zarr' and is_done('route', f'{vpu}/2020'):
+        record('hourly-zarr', vpu, outputs=[f'{zarr_root}/{vpu}.zarr', ])
 
-    def custom_write_outflows(df: pd.DataFrame, outflow_file: str, runoff_file: str) -> None:
-        # hourly_file = outflow_file.replace('Q_', 'Q_hourly_')
-        # with nc.Dataset(hourly_file, mode='w', format='NETCDF4') as ds:
-        #     ds.createDimension('time', size=df.shape[0])
-        #     ds.createDimension('river_id', size=df.shape[1])
-        #     time_var = ds.createVariable('time', 'f8', ('time',))
-        #     time_var.units = f'seconds since {df.index[0].strftime("%Y-%m-%d %H:%M:%S")}'
-        #     time_var[:] = df.index.values - df.index.values[0]
-        #     id_var = ds.createVariable('river_id', 'i4', ('river_id',), )
-        #     id_var[:] = df.columns.values
-        #     flow_var = ds.createVariable('Q', 'f4', ('time', 'river_id'), zlib=True, complevel=3)
-        #     flow_var[:] = df.values
-        #     flow_var.long_name = 'Discharge at catchment outlet'
-        #     flow_var.standard_name = 'discharge'
-        #     flow_var.aggregation_method = 'mean'
-        #     flow_var.units = 'm3 s-1'
-
-        max_file = outflow_file.replace('Q_', 'Q_monmax_')
-        df_max = df.groupby(df.index.strftime('%Y%m01')).max()
-        df_max.index = pd.to_datetime(df_max.index)
-        with nc.Dataset(max_file, mode='w', format='NETCDF4') as ds:
-            ds.createDimension('time', size=df_max.shape[0])
-            ds.createDimension('river_id', size=df_max.shape[1])
-            time_var = ds.createVariable('time', 'f8', ('time',))
-            time_var.units = f'seconds since {df.index[0].strftime("%Y-%m-%d %H:%M:%S")}'
-            time_var[:] = df_max.index.values - df_max.index.values[0]
-            id_var = ds.createVariable('river_id', 'i4', ('river_id',), )
-            id_var[:] = df_max.columns.values
-            flow_var = ds.createVariable('Q', 'f4', ('time', 'river_id'), zlib=True, complevel=3)
-            flow_var[:] = df_max.values
-            flow_var.long_name = 'Discharge at catchment outlet'
-            flow_var.standard_name = 'discharge'
-            flow_var.aggregation_method = 'max'
-            flow_var.units = 'm3 s-1'
-
-        # daily_file = outflow_file.replace('Q_', 'Q_daily_')
-        # df = df.groupby(df.index.strftime('%Y%m%d')).mean()
-        # df.index = pd.to_datetime(df.index)
-        # with nc.Dataset(daily_file, mode='w', format='NETCDF4') as ds:
-        #     df.index = pd.to_datetime(df.index)
-        #     ds.createDimension('time', size=df.shape[0])
-        #     ds.createDimension('river_id', size=df.shape[1])
-        #     time_var = ds.createVariable('time', 'f8', ('time',))
-        #     time_var.units = f'seconds since {df.index[0].strftime("%Y-%m-%d %H:%M:%S")}'
-        #     time_var[:] = df.index.values - df.index.values[0]
-        #     id_var = ds.createVariable('river_id', 'i4', ('river_id',), )
-        #     id_var[:] = df.columns.values
-        #     flow_var = ds.createVariable('Q', 'f4', ('time', 'river_id'), zlib=True, complevel=3)
-        #     flow_var[:] = df.values
-        #     flow_var.long_name = 'Discharge at catchment outlet'
-        #     flow_var.standard_name = 'discharge'
-        #     flow_var.aggregation_method = 'mean'
-        #     flow_var.units = 'm3 s-1'
-
-        # monthly_file = outflow_file.replace('Q_', 'Q_monthly_')
-        # df = df.groupby(df.index.strftime('%Y%m01')).mean()
-        # df.index = pd.to_datetime(df.index)
-        # with nc.Dataset(monthly_file, mode='w', format='NETCDF4') as ds:
-        #     ds.createDimension('time', size=df.shape[0])
-        #     ds.createDimension('river_id', size=df.shape[1])
-        #     time_var = ds.createVariable('time', 'f8', ('time',))
-        #     time_var.units = f'seconds since {df.index[0].strftime("%Y-%m-%d %H:%M:%S")}'
-        #     time_var[:] = df.index.values - df.index.values[0]
-        #     id_var = ds.createVariable('river_id', 'i4', ('river_id',), )
-        #     id_var[:] = df.columns.values
-        #     flow_var = ds.createVariable('Q', 'f4', ('time', 'river_id'), zlib=True, complevel=3)
-        #     flow_var[:] = df.values
-        #     flow_var.long_name = 'Discharge at catchment outlet'
-        #     flow_var.standard_name = 'discharge'
-        #     flow_var.aggregation_method = 'mean'
-        #     flow_var.units = 'm3 s-1'
+
+def state_job(state_file) -> str:
+    # routing jobs in the manifest are {vpu}/{decade}, done once the decade's final state is written
+    year = int(os.path.basename(state_file).split('_')[1][:4])
+    return f'{os.path.basename(os.path.dirname(state_file))}/{year // 10 * 10}'
+
+
+def completes_decade(state_file) -> bool:
+    # only the states that end a decade (or the record, which ends in 2024) complete a job, not mid decade checkpoints
+    stamp = os.path.basename(state_file).split('_')[1][:12]
+    return stamp[4:] == '12312300' and (stamp[3] == '9' or int(stamp[:4]) >= 2024)
+
+
+def record_state(state_file, seconds) -> None:
+    # seconds is the wall time spent routing since the previous state was written
+    if completes_decade(state_file):
+        record('route', state_job(state_file), outputs=[state_file, ], seconds=seconds, checksum=True)
+
+
+def seed_manifest() -> None:
+    # routing done before the manifest existed is found with one glob instead of globs per vpu
+    state_files = glob(os.path.join(discharge_root, '*', 'finalstate_*.parquet'))
+    record_many('route', [(state_job(f), [f, ]) for f in state_files if completes_decade(f)])
+
+
+def route_append(vpu, params_modified, connectivity_file) -> None:
+    """
+    Route only the volumes files after the latest final state, starting from that state
+    """
+    checkpoints = natsorted(glob(f'{discharge_root}/{vpu}/finalstate_*.parquet'))
+    if not checkpoints:
+        print(f'Skipping {vpu}: no final state to append to')
+        return
+    initial_state_file = checkpoints[-1]
+    resume_after = os.path.basename(initial_state_file).split('_')[1][:6]
+    volumes = natsorted(glob(os.path.join(volumes_root, vpu, 'volumes_*.nc')))
+    volumes = [v for v in volumes if os.path.basename(v).split('_')[1][:6] > resume_after]
+    if not volumes:
+        print(f'Skipping {vpu}: no volumes after {resume_after}')
         return
+    outflows = [os.path.join(discharge_root, vpu, os.path.basename(f).replace('volumes', 'Q')) for f in volumes]
+    last_hour = pd.Timestamp(os.path.basename(volumes[-1]).split('_')[1][:6] + '01') + pd.offsets.MonthEnd(0)
+    last_hour = last_hour + pd.Timedelta(hours=23)
+    final_state_file = f'{discharge_root}/{vpu}/finalstate_{last_hour.strftime("%Y%m%d%H%M")}.parquet'
+    print(f'Routing {vpu} {len(volumes)} new months from {initial_state_file}')
+    started = time.time()
+    (
+        rr
+        .Muskingum(**{
+            'routing_params_file': params_modified,
+            'connectivity_file': connectivity_file,
+            'catchment_volumes_file': volumes,
+            'outflow_file': outflows,
+            'initial_state_file': initial_state_file,
+            'final_state_file': final_state_file,
+            'dt_routing': 3600,
+            'progress_bar': False,
+            'log_stream': f'{discharge_root}/{vpu}/log_append_{resume_after}.log',
+        })
+        .set_write_outflows(custom_write_outflows)
+        .route()
+    )
+    record_state(final_state_file, time.time() - started)
+    print(f'Finished routing {vpu} through {last_hour}')
 
+
+def route_decades(vpu, params_modified, connectivity_file) -> None:
     for decade in range(1940, 2030, 10):
-        first3 = str(decade)[:3]
-        volumes = natsorted(glob(os.path.join(volumes_root, vpu, f'volumes_{first3}*.nc')))
-        outflows = [os.path.join(discharge_root, vpu, os.path.basename(f).replace('volumes', 'Q')) for f in volumes]
-
-        final_state_file = f'{discharge_root}/{vpu}/finalstate_202412312300.parquet' \
-            if decade == 2020 else f'{discharge_root}/{vpu}/finalstate_{decade + 9}12312300.parquet'
-        initial_state_file = '' if decade == 1940 else f'{discharge_root}/{vpu}/finalstate_{decade - 1}12312300.parquet'
-        if os.path.exists(final_state_file):
-            print(f'Skipping {vpu}: {decade} final state already exists')
-            continue
-        if initial_state_file != '' and not os.path.exists(initial_state_file):
-            print(f'Skipping {vpu}: {decade} initial state does not exist')
-            continue
-        if len(volumes) != 120 and decade != 2020:
-            print(f'Skipping {vpu}: {decade} volumes not found')
-            continue
-        if len(volumes) != 60 and decade == 2020:
-            print(f'Skipping {vpu}: {decade} volumes not found')
-            continue
-        print(f'Routing {vpu} decade {decade}')
+        route_decade(vpu, params_modified, connectivity_file, decade)
+
+
+def route_decade(vpu, params_modified, connectivity_file, decade) -> None:
+    first3 = str(decade)[:3]
+    volumes = natsorted(glob(os.path.join(volumes_root, vpu, f'volumes_{first3}*.nc')))
+    outflows = [os.path.join(discharge_root, vpu, os.path.basename(f).replace('volumes', 'Q')) for f in volumes]
+
+    final_state_file = f'{discharge_root}/{vpu}/finalstate_202412312300.parquet' \
+        if decade == 2020 else f'{discharge_root}/{vpu}/finalstate_{decade + 9}12312300.parquet'
+    initial_state_file = '' if decade == 1940 else f'{discharge_root}/{vpu}/finalstate_{decade - 1}12312300.parquet'
+    if os.path.exists(final_state_file):
+        print(f'Skipping {vpu}: {decade} final state already exists')
+        return
+    if initial_state_file != '' and not os.path.exists(initial_state_file):
+        print(f'Skipping {vpu}: {decade} initial state does not exist')
+        return
+    if len(volumes) != 120 and decade != 2020:
+        print(f'Skipping {vpu}: {decade} volumes not found')
+        return
+    if len(volumes) != 60 and decade == 2020:
+        print(f'Skipping {vpu}: {decade} volumes not found')
+        return
+    print(f'Routing {vpu} decade {decade}')
+    started = time.time()
+    if engine == 'stream':
+        network, operators = read_operators(params_modified, connectivity_file)
+        q, r = read_state(initial_state_file, network[0].shape[0])
+        routed = route_blocks(network, (read_volumes(f) for f in volumes), q, r, 3600, operators)
+        for volumes_file, outflow_file, (df, q, r) in zip(volumes, outflows, routed):
+            custom_write_outflows(df, outflow_file, volumes_file)
+        write_state(final_state_file, q, r)
+    else:
         (
             rr
             .Muskingum(**{
@@ -131,33 +426,205 @@ def route(configs):
             .set_write_outflows(custom_write_outflows)
             .route()
         )
-        print(f'Finished routing {vpu} decade {decade}')
+    record_state(final_state_file, time.time() - started)
+    print(f'Finished routing {vpu} decade {decade}')
+
+
+def input_decades(monthly_inputs) -> list:
+    return sorted(set(int(file_month(f)[:3]) * 10 for f in monthly_inputs))
+
+
+def decade_months(monthly_inputs, decade) -> list:
+    return [f for f in monthly_inputs if file_month(f)[:3] == str(decade)[:3]]
+
+
+def month_state_file(vpu, month) -> str:
+    # named by the last hour of the month like the decade runs
+    last_hour = pd.Timestamp(month + '01') + pd.offsets.MonthEnd(0) + pd.Timedelta(hours=23)
+    return f'{discharge_root}/{vpu}/finalstate_{last_hour.strftime("%Y%m%d%H%M")}.parquet'
+
+
+def parareal_file(vpu, name) -> str:
+    return f'{discharge_root}/{vpu}/parareal_{name}'
+
+
+def states_match(q, estimate) -> bool:
+    return np.allclose(q, estimate, rtol=parareal_rtol, atol=parareal_atol)
+
+
+def route_decade_estimate(args) -> None:
+    """
+    Parareal first pass: route one decade from an estimated initial state, the state reached by routing the
+    spinup_months before the decade from rest. The first decade starts from rest like the serial chain, so it is
+    already exact. Saves the estimated initial state, the final state and the state at each year end for
+    correct_decades.
+    """
+    configs, decade = args
+    started = time.time()
+    vpu = os.path.basename(configs)
+    monthly_inputs = list_monthly_inputs(vpu)
+    months = decade_months(monthly_inputs, decade)
+    network, operators = read_operators(
+        f'{configs}/routing_parameters_faster.parquet', f'{configs}/connectivity.parquet'
+    )
+    q, r = read_state('', network[0].shape[0])
+    first = monthly_inputs.index(months[0])
+    spinup = monthly_inputs[max(0, first - spinup_months):first]
+    spinup_volumes = (read_monthly_volumes(configs, f) for f in spinup)
+    for _, q, r in route_blocks(network, spinup_volumes, q, r, operators=operators):
+        pass
+    is_first_decade = decade == input_decades(monthly_inputs)[0]
+    if not is_first_decade:
+        write_state(parareal_file(vpu, f'guess_{decade}.parquet'), q, r)
+
+    print(f'Routing {vpu} decade {decade} from an estimated state')
+    year_end_q = []
+    volumes = (read_monthly_volumes(configs, f) for f in months)
+    for monthly_input, (outflows, q, r) in zip(months, route_blocks(network, volumes, q, r, operators=operators)):
+        custom_write_outflows(outflows, monthly_outflow_file(vpu, monthly_input), monthly_input)
+        if outflows.index[-1].month == 12:
+            year_end_q.append(q)
+    flush_annual_max(vpu)
+    if is_first_decade:
+        write_state(month_state_file(vpu, file_month(months[-1])), q, r)
+        record_state(month_state_file(vpu, file_month(months[-1])), time.time() - started)
+    else:
+        write_state(parareal_file(vpu, f'estimate_{decade}.parquet'), q, r)
+        np.save(parareal_file(vpu, f'years_{decade}.npy'), np.array(year_end_q))
+    print(f'Finished estimating {vpu} decade {decade}')
+
+
+@instrumented('route-correct')
+def correct_decades(configs) -> None:
+    """
+    Parareal correction, run once every decade of the vpu has an estimate. Walking forward in time, each decade's
+    estimated initial state is compared with the final state of the decade before it. Where they differ by more than
+    the tolerance, the decade is routed again from the correct state one year at a time until its state at the end of
+    a year matches the estimate. The routing is linear, so the rest of the decade then agrees with the serial chain
+    within the tolerance and is kept.
+    """
+    vpu = os.path.basename(configs)
+    monthly_inputs = list_monthly_inputs(vpu)
+    decades = input_decades(monthly_inputs)
+    router = None
+    for previous, decade in zip(decades[:-1], decades[1:]):
+        months = decade_months(monthly_inputs, decade)
+        final_file = month_state_file(vpu, file_month(months[-1]))
+        if os.path.exists(final_file):
+            continue
+        started = time.time()
+        initial_file = month_state_file(vpu, file_month(decade_months(monthly_inputs, previous)[-1]))
+        q, r = read_state(initial_file, None)
+        guess_q, _ = read_state(parareal_file(vpu, f'guess_{decade}.parquet'), None)
+        year_end_q = np.load(parareal_file(vpu, f'years_{decade}.npy'))
+        converged = states_match(q, guess_q)
+        if not converged:
+            router = router or read_operators(
+                f'{configs}/routing_parameters_faster.parquet', f'{configs}/connectivity.parquet'
+            )
+            network, operators = router
+            years = natsorted(set(file_month(f)[:4] for f in months))
+            for i, year in enumerate(years):
+                year_months = [f for f in months if file_month(f)[:4] == year]
+                volumes = (read_monthly_volumes(configs, f) for f in year_months)
+                routed = route_blocks(network, volumes, q, r, operators=operators)
+                for monthly_input, (outflows, q, r) in zip(year_months, routed):
+                    custom_write_outflows(outflows, monthly_outflow_file(vpu, monthly_input), monthly_input)
+                flush_annual_max(vpu)
+                print(f'Corrected {vpu} {year}')
+                if i < year_end_q.shape[0] and states_match(q, year_end_q[i]):
+                    converged = True
+                    break
+        if converged:
+            os.replace(parareal_file(vpu, f'estimate_{decade}.parquet'), final_file)
+        else:
+            write_state(final_file, q, r)
+        record_state(final_file, time.time() - started)
+        for name in (f'guess_{decade}.parquet', f'estimate_{decade}.parquet', f'years_{decade}.npy'):
+            if os.path.exists(parareal_file(vpu, name)):
+                os.remove(parareal_file(vpu, name))
+        print(f'Finished correcting {vpu} decade {decade}')
+    mark_zarr_complete(vpu)
+
+
+def pending_decades(configs) -> list:
+    vpu = os.path.basename(configs)
+    monthly_inputs = list_monthly_inputs(vpu)
+    pending = []
+    for decade in input_decades(monthly_inputs):
+        months = decade_months(monthly_inputs, decade)
+        if not os.path.exists(month_state_file(vpu, file_month(months[-1]))) and \
+                not os.path.exists(parareal_file(vpu, f'estimate_{decade}.parquet')):
+            pending.append((configs, decade))
+    return pending
 
 
 if __name__ == '__main__':
     configs_dirs = natsorted(glob(os.path.join(configs_root, '*')))
     configs_dirs = [d for d in configs_dirs if os.path.isdir(d)]
 
-    completed_volumes = natsorted(glob(os.path.join(volumes_root, '*')))
-    completed_volumes = [v for v in completed_volumes if os.path.isdir(v)]
-    completed_volumes = [os.path.basename(v) for v in completed_volumes]
-
-    complete_routing = natsorted(glob(os.path.join(discharge_root, '*', 'finalstate_202412312300.parquet')))
-    complete_routing = [os.path.dirname(c) for c in complete_routing]
+    if stage_is_empty('route'):
+        seed_manifest()
+    completed_volumes = {job.split('/')[0] for job in jobs_in_state('volumes')}
+    complete_routing = {job.split('/')[0] for job in jobs_in_state('route') if job.endswith('/2020')}
 
     skip = []
     skip = [f'vpu={s}' for s in skip]
     configs_dirs = [c for c in configs_dirs if os.path.basename(c) not in skip]
-    configs_dirs = [c for c in configs_dirs if os.path.basename(c) in completed_volumes]
-    configs_dirs = [c for c in configs_dirs if os.path.basename(c) not in complete_routing]
-    configs_dirs = sorted(configs_dirs, key=lambda x: -pd.read_parquet(f'{x}/routing_parameters.parquet').shape[0])
-
-    if len(configs_dirs) == 0:
-        print('No routing to do')
-    elif len(configs_dirs) == 1:
-        route(configs_dirs[0])
+    if pipeline == 'files':
+        configs_dirs = [c for c in configs_dirs if os.path.basename(c) in completed_volumes]
+    if not append:
+        configs_dirs = [c for c in configs_dirs if os.path.basename(c) not in complete_routing]
+    n_rivers = {c: parquet_rows(c) for c in configs_dirs}
+    configs_dirs = sorted(configs_dirs, key=lambda x: -n_rivers[x])
+    # time scales with rivers x months, memory with the rivers since one month is routed and held at a time
+    route_cost = cost_model('route', 1e-6, 1e-2)
+
+    if parareal:
+        # every decade of every vpu is routed at once, then each vpu's decades are corrected in order. the decades of a
+        # vpu write their own years into its maxima store (one year per chunk row), which is extended through the last
+        # year here so the concurrent decades never resize it. the hourly zarr has time chunks that cross the decade
+        # boundaries, so concurrent decades would overwrite each other's rows in it.
+        if outflow_format == 'zarr' and 'hourly' in outflow_products:
+            raise ValueError('parareal routing cannot write the hourly product to zarr, use outflow_format = netcdf')
+        for configs in configs_dirs:
+            prepare_outputs(configs)
+            monthly_inputs = list_monthly_inputs(os.path.basename(configs))
+            if 'annmax' in outflow_products and monthly_inputs:
+                maxima_row(os.path.basename(configs), int(file_month(monthly_inputs[-1])[:4]))
+        jobs = [job for configs in configs_dirs for job in pending_decades(configs)]
+        run_jobs(
+            route_decade_estimate, jobs, 'route', names=[f'{os.path.basename(c)} {d}' for c, d in jobs],
+            units=[n_rivers[c] * 120 for c, _ in jobs], memory_units=[n_rivers[c] for c, _ in jobs], cost=route_cost,
+            n_workers=92, ram_budget_mb=ram_budget_mb,
+        )
+        with fork.Pool(min([max(len(configs_dirs), 1), 92])) as p:
+            p.map(correct_decades, configs_dirs)
     else:
-        with Pool(min([len(configs_dirs), 92])) as p:
-            p.map(route, configs_dirs)
-            p.close()
-            p.join()
+        # a vpu's time is sized by its rivers x the months of input it has, whether routed or not
+        units = {c: n_rivers[c] * len(list_monthly_inputs(os.path.basename(c))) for c in configs_dirs}
+        split_dirs = [c for c in configs_dirs if n_rivers[c] > split_rivers]
+        configs_dirs = [c for c in configs_dirs if n_rivers[c] <= split_rivers]
+        n_workers = 92
+        budget_mb = ram_budget_mb
+        splitter = None
+        if split_dirs:
+            # the largest vpus would be the critical path if routed whole, so they are split across workers_per_vpu
+            # processes and routed in their own process while the pool routes the other vpus on the remaining cores
+            splitter = fork.Process(target=route_split, args=(split_dirs, ))
+            splitter.start()
+            n_workers -= workers_per_vpu
+            budget_mb -= max(route_cost(units[c], n_rivers[c])[1] for c in split_dirs)
+
+        if len(configs_dirs) == 0 and not split_dirs:
+            print('No routing to do')
+        elif len(configs_dirs) == 1:
+            route(configs_dirs[0])
+        elif configs_dirs:
+            run_jobs(
+                route, configs_dirs, 'route', names=[os.path.basename(c) for c in configs_dirs],
+                units=[units[c] for c in configs_dirs], memory_units=[n_rivers[c] for c in configs_dirs],
+                cost=route_cost, n_workers=n_workers, ram_budget_mb=budget_mb,
+            )
+        if splitter is not None:
+            splitter.join()
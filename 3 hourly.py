@@ -1,21 +1,49 @@
 import os
+import time
 from concurrent.futures import ThreadPoolExecutor as ThreadPool
 from glob import glob
-from multiprocessing import Pool
 
 import dask
-import numcodecs
+import numpy as np
+import pyarrow.parquet as pq
 import xarray as xr
 from natsort import natsorted
 
+from instrument import instrumented
+from manifest import is_done, jobs_in_state, record
+from scheduler import fork
+from zarr_stores import assemble_global_store, create_store, open_variable
+
 discharge_root = '/mnt/discharge'
 zarr_root = '/mnt/zarr/hourly'
 final_root = '/mnt/zarr/final'
 configs_root = '/home/ubuntu/routing_configs'
+final_chunks = {'time': -1, 'river_id': 20}
+# e.g. {'time': -1, 'river_id': 500}: zarr v3 with 25 chunks per shard file, written by decoding each vpu instead of
+# copying its chunk files
+final_shards = None
+rivers_per_write = 5_000  # rivers of a vpu converted at once (about 15 GB), a multiple of the final river_id chunks
 os.makedirs(zarr_root, exist_ok=True)
 os.makedirs(final_root, exist_ok=True)
 
 
+def global_river_offsets() -> dict:
+    # each vpu's position in the final store, from the parquet row counts in the same (natsorted) order as the assembly
+    configs_dirs = [d for d in natsorted(glob(os.path.join(configs_root, '*'))) if os.path.isdir(d)]
+    counts = [pq.ParquetFile(f'{d}/routing_parameters.parquet').metadata.num_rows for d in configs_dirs]
+    return dict(zip([os.path.basename(d) for d in configs_dirs], np.cumsum([0, ] + counts)[:-1]))
+
+
+def vpu_zarr_path(vpu):
+    return f'{zarr_root}/{vpu}.zarr'
+
+
+def open_vpu_zarr(vpu):
+    ds = xr.open_zarr(vpu_zarr_path(vpu))
+    return ds.isel(river_id=slice(ds.attrs.get('river_id_lead', 0), None))
+
+
+@instrumented('convert')
 def convert(vpu):
     try:
         n = 15
@@ -25,7 +53,7 @@ def convert(vpu):
             netcdfs = list(natsorted(glob(f'{discharge_root}/{vpu}/Q_hourly*.nc')))
 
             # Skip processing if input files are missing or output exists
-            if os.path.exists(f'/home/ubuntu/{vpu}_zarr_complete.txt'):
+            if is_done('hourly-zarr', vpu):
                 print(f'------------Skipping {vpu}: zarr conversion already complete')
                 return
             if os.path.exists(output_zarr):
@@ -35,31 +63,64 @@ def convert(vpu):
                 print(f'------------Error {output_zarr}: 1020 source netcdfs not found')
                 return
 
-            # Use Dask to process the dataset in parallel
-            (
-                xr
-                .open_mfdataset(netcdfs, combine='by_coords', parallel=True)
-                .chunk({'time': -1, 'river_id': 500})
-                .to_zarr(
-                    output_zarr,
-                    mode='w',
-                    zarr_format=2,
-                    consolidated=True,
-                    compute=True,
-                    encoding={
-                        'Q': {
-                            'compressor': numcodecs.Blosc(cname='zstd', clevel=5, shuffle=numcodecs.Blosc.AUTOSHUFFLE)
-                        }
-                    }
-                )
+            # pad the start of the vpu so its river_id chunks line up with the final store and can be copied unchanged.
+            # the store is created empty with the final chunks and encoding and filled one block of rivers at a time,
+            # each block read from every month with the threads, so the dask graph is one block and memory is bounded.
+            ds = xr.open_mfdataset(netcdfs, combine='by_coords', parallel=True)
+            lead = int(global_river_offsets()[vpu] % final_chunks['river_id'])
+            source = ds['Q'].transpose('time', 'river_id')
+            create_store(
+                output_zarr,
+                dims=('time', 'river_id'),
+                coords={
+                    'time': ds['time'].values,
+                    'river_id': np.concatenate([np.full(lead, -1, dtype=ds['river_id'].dtype), ds['river_id'].values]),
+                },
+                chunks=final_chunks,
+                dtype=str(source.dtype),
+                attrs={**ds.attrs, 'river_id_lead': lead},
+                var_attrs=source.attrs,
             )
+            started = time.time()
+            array = open_variable(output_zarr)
+            n_padded = lead + source.shape[1]
+            for a in range(0, n_padded, rivers_per_write):
+                b = min(a + rivers_per_write, n_padded)
+                start = max(a, lead)
+                array[:, start:b] = source[:, start - lead:b - lead].values
             print(f'\tFinished zarr conversion for {vpu}')
-            with open(f'/home/ubuntu/{vpu}_zarr_complete.txt', 'w') as f:
-                f.write('completed')
+            record('hourly-zarr', vpu, outputs=[output_zarr, ], seconds=time.time() - started)
             return
     except Exception as e:
-        with open(f'/home/ubuntu/{vpu}_zarr_error.txt', 'w') as f:
-            f.write(str(e))
+        print(f'------------Error {vpu}: {e}')
+        record('hourly-zarr', vpu, state='error')
+        raise
+
+
+def assemble() -> None:
+    attrs = {
+        "title": "River Forecast System v2 Hourly Retrospective Simulation",
+        "description": "Hourly simulation of global rivers since 1940 based on TDX-Hydro hydrography, ERA5 meteorology reanalysis, and matrix Muskingum vector routing using river-route.",
+        "author": "Riley Chad Hales, PhD",
+        "creation_date": "2025-02-22",
+        "license": "CC-BY-NC-SA 4.0",
+        "copyright": "2025",
+        "revision": "1"
+    }
+    print('writing zarr')
+    started = time.time()
+    assemble_global_store(
+        open_vpu_zarr,
+        natsorted([os.path.basename(z).replace('.zarr', '') for z in glob(f'{zarr_root}/*.zarr')]),
+        f'{final_root}/hourly.zarr',
+        chunks=final_chunks,
+        attrs=attrs,
+        n_workers=24,
+        rivers_per_write=500,
+        vpu_store=vpu_zarr_path,
+        shards=final_shards,
+    )
+    record('final', 'hourly.zarr', outputs=[f'{final_root}/hourly.zarr', ], seconds=time.time() - started)
 
 
 if __name__ == '__main__':
@@ -67,9 +128,8 @@ if __name__ == '__main__':
     vpus = [d for d in vpus if os.path.isdir(d)]
     vpus = [os.path.basename(vpu) for vpu in vpus]
 
-    completed_routing = natsorted(glob(f'{discharge_root}/*/finalstate_202412312300.parquet'))
-    completed_routing = [os.path.basename(os.path.dirname(c)) for c in completed_routing]
-    completed_conversion = [os.path.basename(t).split('_')[0] for t in glob('/home/ubuntu/*_zarr_complete.txt')]
+    completed_routing = {job.split('/')[0] for job in jobs_in_state('route') if job.endswith('/2020')}
+    completed_conversion = jobs_in_state('hourly-zarr')
 
     skip = []
     skip = [f'vpu={s}' for s in skip]
@@ -78,37 +138,9 @@ if __name__ == '__main__':
     vpus = [vpu for vpu in vpus if vpu not in completed_conversion]
     vpus = natsorted(vpus)
 
-    with Pool(6) as p:  # 3x24 maxes out a 96 vCPU @ 8GB/vCPU machine
+    with fork.Pool(6) as p:  # 3x24 maxes out a 96 vCPU @ 8GB/vCPU machine
         for v in vpus:
             p.apply_async(convert, args=(v,))
         p.close()
         p.join()
-
-    print('opening zarrs')
-    ds = xr.concat([xr.open_zarr(z) for z in natsorted(glob(f'{zarr_root}/*.zarr'))], dim='river_id')
-    ds.attrs = {
-        "title": "River Forecast System v2 Hourly Retrospective Simulation",
-        "description": "Hourly simulation of global rivers since 1940 based on TDX-Hydro hydrography, ERA5 meteorology reanalysis, and matrix Muskingum vector routing using river-route.",
-        "author": "Riley Chad Hales, PhD",
-        "creation_date": "2025-02-22",
-        "license": "CC-BY-NC-SA 4.0",
-        "copyright": "2025",
-        "revision": "1"
-    }
-    print('writing zarr')
-    (
-        ds
-        .chunk({'time': -1, 'river_id': 20})
-        .to_zarr(
-            f'{final_root}/hourly.zarr',
-            mode='w',
-            zarr_format=2,
-            compute=True,
-            consolidated=True,
-            encoding={
-                'Q': {'compressor': numcodecs.Blosc(cname='zstd', clevel=5, shuffle=numcodecs.Blosc.AUTOSHUFFLE)}
-            },
-        )
-    )
-    with open(f'/home/ubuntu/zarr-hourly-complete', 'w') as f:
-        f.write('complete')
+    assemble()
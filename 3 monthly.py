@@ -1,29 +1,53 @@
 import os
 from glob import glob
 
-import numcodecs
+import numpy as np
 import pandas as pd
 import xarray as xr
 from natsort import natsorted
 
+from rechunk import rechunk, write_layouts
+from zarr_stores import assemble_global_store, create_store, read_vpu_layout
+
 discharge_root = '/mnt/discharge'
 configs_root = '/home/ubuntu/routing_configs'
 vpus = [d for d in natsorted(glob(os.path.join(discharge_root, '*'))) if os.path.isdir(d)]
 resolution = 'monthly'
+timeseries_zarr = '/mnt/zarr/final/monthly-timeseries.zarr'
+timesteps_zarr = '/mnt/zarr/final/monthly-timesteps.zarr'
+timeseries_chunks = {'time': -1, 'river_id': 1_000}
+timesteps_chunks = {'time': 1, 'river_id': 1_000_000}
+# e.g. {'time': -1, 'river_id': 100_000} and {'time': 12, 'river_id': 1_000_000}: zarr v3 with the chunks grouped into
+# shard files, which the first-write blocks already span
+timeseries_shards = None
+timesteps_shards = None
+timesteps_from = 'first-write'  # 'first-write': both layouts from the same blocks, 'rechunk': rechunk the timeseries
+memory_budget = 4 * 1024 ** 3  # bytes per rechunk worker
+vpu_layout = None  # first-write: (vpus, offsets) of the concatenated vpus
+
+
+def open_vpu(vpu):
+    ds = xr.open_mfdataset(natsorted(glob(os.path.join(vpu, f'Q_{resolution}_*.nc'))))
+    times = pd.to_datetime(ds['time'].values)
+    force_left_aligned_times = [f'{t.year}-{t.month:02d}-01' for t in times]
+    force_left_aligned_times = pd.to_datetime(force_left_aligned_times)
+    force_left_aligned_times = force_left_aligned_times + pd.DateOffset(months=1)
+    return ds.assign_coords({'time': force_left_aligned_times})
+
+
+def read_rivers(r0, r1):
+    # global rivers r0:r1 from the vpus that overlap them
+    pieces = []
+    for vpu, offset, end in zip(vpu_layout[0], vpu_layout[1][:-1], vpu_layout[1][1:]):
+        if offset < r1 and end > r0:
+            a, b = max(r0, offset) - offset, min(r1, end) - offset
+            with open_vpu(vpu) as ds:
+                pieces.append(ds['Q'].transpose('time', 'river_id')[:, a:b].values)
+    return np.concatenate(pieces, axis=1)
+
 
 if __name__ == '__main__':
-    # make the first vpus's netcdfs into a zarr then append the others sequentially
-    print(f'opening first vpu {vpus[0]}')
-    ds = xr.open_mfdataset(natsorted(glob(os.path.join(vpus[0], f'Q_{resolution}_*.nc'))))
-    for vpu in vpus[1:]:
-        print(f'concatenating with vpu {vpu}')
-        ds = (
-            xr.concat([
-                ds,
-                xr.open_mfdataset(natsorted(glob(os.path.join(vpu, f'Q_{resolution}_*.nc'))))
-            ], dim='river_id', )
-        )
-    ds.attrs = {
+    attrs = {
         "title": f"River Forecast System v2 {resolution.title()} Retrospective Simulation",
         "description": f"{resolution.title()} simulation of global rivers since 1940 based on TDX-Hydro hydrography, ERA5 meteorology reanalysis, and matrix Muskingum vector routing using river-route.",
         "author": "Riley Chad Hales, PhD",
@@ -32,44 +56,52 @@ if __name__ == '__main__':
         "copyright": "2025",
         "revision": "1"
     }
-    times = pd.to_datetime(ds['time'].values)
-    force_left_aligned_times = [f'{t.year}-{t.month:02d}-01' for t in times]
-    force_left_aligned_times = pd.to_datetime(force_left_aligned_times)
-    force_left_aligned_times = force_left_aligned_times + pd.DateOffset(months=1)
-    print('writing zarr')
-    (
-        ds
-        .assign_coords({'time': force_left_aligned_times})
-        .chunk({'time': -1, 'river_id': 1_000})
-        .to_zarr(
-            '/mnt/zarr/final/monthly-timeseries.zarr',
-            mode='w',
-            zarr_format=2,
-            compute=True,
-            consolidated=True,
-            encoding={
-                'Q': {'compressor': numcodecs.Blosc(cname='zstd', clevel=5, shuffle=numcodecs.Blosc.AUTOSHUFFLE)}
-            },
+    if timesteps_from == 'first-write':
+        print('writing timeseries and timesteps zarrs')
+        river_ids, offsets, times, var_attrs = read_vpu_layout(open_vpu, vpus, n_workers=24)
+        vpu_layout = (vpus, offsets)
+        layouts = (
+            (timeseries_zarr, timeseries_chunks, timeseries_shards),
+            (timesteps_zarr, timesteps_chunks, timesteps_shards),
         )
-    )
-    with open(f'/home/ubuntu/zarr-{resolution}-complete', 'w') as f:
-        f.write('complete')
+        for path, chunks, shards in layouts:
+            create_store(
+                path,
+                dims=('time', 'river_id'),
+                coords={'time': times, 'river_id': np.concatenate(river_ids)},
+                chunks=chunks,
+                attrs=attrs,
+                var_attrs=var_attrs,
+                shards=shards,
+            )
+        # each block holds every month of 1M rivers (about 4 GB)
+        write_layouts(read_rivers, offsets[-1], [timeseries_zarr, timesteps_zarr], n_workers=16)
+        with open(f'/home/ubuntu/zarr-{resolution}-complete', 'w') as f:
+            f.write('complete')
+    else:
+        print('writing zarr')
+        assemble_global_store(
+            open_vpu,
+            vpus,
+            timeseries_zarr,
+            chunks=timeseries_chunks,
+            attrs=attrs,
+            n_workers=24,
+            rivers_per_write=50_000,
+            shards=timeseries_shards,
+        )
+        with open(f'/home/ubuntu/zarr-{resolution}-complete', 'w') as f:
+            f.write('complete')
 
-    print('rewriting zarr with timesteps oriented chunks')
-    (
-        xr
-        .open_zarr('/mnt/zarr/final/monthly-timeseries.zarr')
-        .chunk({'time': 1, 'river_id': 1_000_000})
-        .to_zarr(
-            '/mnt/zarr/final/monthly-timesteps.zarr',
-            mode='w',
-            zarr_format=2,
-            compute=True,
-            consolidated=True,
-            encoding={
-                'Q': {'compressor': numcodecs.Blosc(cname='zstd', clevel=5, shuffle=numcodecs.Blosc.AUTOSHUFFLE)}
-            },
+        print('rewriting zarr with timesteps oriented chunks')
+        rechunk(
+            timeseries_zarr,
+            timesteps_zarr,
+            timesteps_chunks,
+            memory_budget=memory_budget,
+            n_workers=24,
+            intermediate_path='/mnt/zarr/final/monthly-intermediate.zarr',
+            target_shards=timesteps_shards,
         )
-    )
     with open(f'/home/ubuntu/zarr-{resolution}-timesteps-complete', 'w') as f:
         f.write('complete')
@@ -1,160 +1,125 @@
 import os
-from multiprocessing import Pool
 
 import numpy as np
 import xarray as xr
 
+from instrument import instrumented
+from scheduler import fork
+from zarr_stores import create_variables_store, open_variable
+
 # Configuration parameters
 zarr_variable = 'Q'
 earliest_date = '1950-01-01'
 latest_date = '2024-12-31'
 resolution = 'daily'
-n_rivers = xr.open_zarr(f'/mnt/zarr/final/{resolution}.zarr').river_id.shape[0]
-base_step_size = 140
-os.makedirs('/mnt/zarr/fdc', exist_ok=True)
+discharge_zarr = f'/mnt/zarr/final/{resolution}.zarr'
+n_rivers = None  # read from discharge_zarr by the main block
+fdc_zarr = '/mnt/zarr/final/fdc.zarr'
+fdc_chunks = {'p_exceed': 101, 'month': 12, 'river_id': 1000}
+fdc_shards = None  # e.g. {'p_exceed': 101, 'month': 12, 'river_id': 10_000}: zarr v3 with 10 chunks per shard file
+rivers_per_job = (fdc_shards or fdc_chunks)['river_id']  # each job fills whole river_id chunks (or shards) of the store
+rivers_per_sort = 1000 if resolution == 'daily' else 100  # rivers sorted at once, bounds the memory of each worker
+percentiles = np.arange(100, -1, -1)  # Define the percentiles in a gap of 1
+fdc_dtype = 'float64'  # 'float32' halves the store, the discharge is float32 so its percentiles lose little
+
+
+def sorted_percentiles(sorted_values, percentiles):
+    """
+    np.percentile (linear interpolation) of every column of an array that is already sorted along axis 0. Columns
+    containing nan give nan, like np.percentile.
+    """
+    positions = (sorted_values.shape[0] - 1) * percentiles / 100
+    lower = np.floor(positions).astype(int)
+    upper = np.ceil(positions).astype(int)
+    weights = (positions - lower).reshape(-1, 1)
+    result = sorted_values[lower] * (1 - weights) + sorted_values[upper] * weights
+    result[:, np.isnan(sorted_values[-1])] = np.nan  # nan sorts last
+    return result
+
+
+def create_fdc_store() -> None:
+    """
+    Create the empty store shared by the daily and hourly runs: fdc_{resolution} over all data and
+    fdc_{resolution}_monthly by month of the year. Each run fills only its own variables.
+    """
+    with xr.open_zarr(discharge_zarr) as ds:
+        river_ids = ds['river_id'].values
+    variables = {}
+    for res in ('daily', 'hourly'):
+        variables[f'fdc_{res}'] = (('p_exceed', 'river_id'), fdc_dtype, {})
+        variables[f'fdc_{res}_monthly'] = (('month', 'p_exceed', 'river_id'), fdc_dtype, {})
+    create_variables_store(
+        fdc_zarr,
+        variables,
+        coords={'month': np.arange(1, 13), 'p_exceed': 100 - percentiles, 'river_id': river_ids},
+        chunks=fdc_chunks,
+        shards=fdc_shards,
+        attrs={
+            "title": "River Forecast System v2 Monthly Retrospective Simulation",
+            "description": "Flow duration curves based on either hourly or daily average simulations, either by month or based on all data.",
+            "author": "Riley Chad Hales, PhD",
+            "creation_date": "2025-01-21",
+            "license": "CC-BY-SA 4.0",
+            "copyright": "2025",
+            "revision": "1",
+        },
+    )
 
 
+@instrumented(f'fdc-{resolution}')
 def hourly_chunk_to_fdcs(start_index) -> None:
     """
-    Convert hydrograph data to Flow Duration Curves (FDCs) for given river IDs.
-    Saves results in zarr v2 format with specific coordinate structure.
+    Convert hydrograph data to Flow Duration Curves (FDCs) for a range of rivers and write them into their region of
+    the fdc store.
     """
-    step_size = base_step_size * 24 if resolution == 'hourly' else base_step_size
-    with xr.open_zarr(f'/mnt/zarr/final/{resolution}.zarr') as ds:
-        # Select the hydrographs for the river_ids
-        df = (
+    end_index = min(start_index + rivers_per_job, n_rivers)
+    with xr.open_zarr(discharge_zarr) as ds:
+        # Select the hydrographs for the river_ids as a (time, river_id) array
+        da = (
             ds
             [zarr_variable]
-            .isel(river_id=slice(start_index, min(start_index + step_size, n_rivers)))
-            .to_dataframe()
-            [zarr_variable]
-            .reset_index()
-            .pivot(columns='river_id', values=zarr_variable, index='time')
-            .loc[earliest_date:latest_date]
+            .isel(river_id=slice(start_index, end_index))
+            .sel(time=slice(earliest_date, latest_date))
+            .transpose('time', 'river_id')
         )
-
-        # Define the percentiles in a gap of 1
-        percentiles = np.arange(100, -1, -1)
-        p_exceed = 100 - percentiles
+        values = da.values
+        months = da['time'].dt.month.values.astype(np.int8)
+
+    annual_percentiles = np.empty((percentiles.shape[0], values.shape[1]))
+    monthly_percentiles = np.empty((12, percentiles.shape[0], values.shape[1]))
+    for a in range(0, values.shape[1], rivers_per_sort):
+        b = min(a + rivers_per_sort, values.shape[1])
+        # sort each river once; each month's values are then the entries of that month in the sorted order
+        order = np.argsort(values[:, a:b], axis=0)
+        sorted_values = np.take_along_axis(values[:, a:b], order, axis=0)
+        sorted_months = months[order]
 
         # Annual calculations
-        annual_percentiles = np.percentile(df.values, percentiles, axis=0)
-
-        # Create xarray DataArray for annual FDC
-        annual_da = xr.DataArray(
-            data=annual_percentiles,
-            coords={
-                'p_exceed': p_exceed,
-                'river_id': df.columns
-            },
-            dims=['p_exceed', 'river_id'],
-            name=f'fdc_{resolution}_total'
-        )
-
-        # Create xarray Dataset for annual FDC
-        annual_ds = annual_da.to_dataset()
-
-        # Save annual FDCs in zarr v2 format
-        annual_file_name = os.path.join('/mnt/zarr/fdc', f'fdc_{resolution}_annual_{start_index}.zarr')
-        encoding = {var: {'compressor': None} for var in annual_ds.data_vars}
-        annual_ds.to_zarr(
-            annual_file_name,
-            mode='w',
-            zarr_format=2,
-            encoding=encoding,
-            consolidated=True
-        )
+        annual_percentiles[:, a:b] = sorted_percentiles(sorted_values, percentiles)
 
         # Monthly calculations
-        monthly_data = []
         for month in range(1, 13):
-            month_percentiles = np.percentile(df[df.index.month == month].values, percentiles, axis=0)
-            monthly_data.append(month_percentiles)
-
-        # Stack monthly data along new month dimension
-        monthly_array = np.stack(monthly_data, axis=0)
-
-        # Create xarray DataArray for monthly FDC
-        monthly_da = xr.DataArray(
-            data=monthly_array,
-            coords={
-                'month': np.arange(1, 13),
-                'p_exceed': p_exceed,
-                'river_id': df.columns
-            },
-            dims=['month', 'p_exceed', 'river_id'],
-            name=f'fdc_{resolution}'
-        )
+            # every river has the same number of values in each month, so the selection reshapes to (river, value)
+            month_sorted = sorted_values.T[sorted_months.T == month].reshape(b - a, -1).T
+            monthly_percentiles[month - 1, :, a:b] = sorted_percentiles(month_sorted, percentiles)
 
-        # Create xarray Dataset for monthly FDC
-        monthly_ds = monthly_da.to_dataset()
-
-        # Save monthly FDCs in zarr v2 format
-        monthly_file_name = os.path.join('/mnt/zarr/fdc', f'fdc_{resolution}_monthly_{start_index}.zarr')
-        encoding = {var: {'compressor': None} for var in monthly_ds.data_vars}
-        monthly_ds.to_zarr(
-            monthly_file_name,
-            mode='w',
-            zarr_format=2,
-            encoding=encoding,
-            consolidated=True
-        )
+    open_variable(fdc_zarr, f'fdc_{resolution}')[:, start_index:end_index] = annual_percentiles
+    open_variable(fdc_zarr, f'fdc_{resolution}_monthly')[:, :, start_index:end_index] = monthly_percentiles
+    print(f'Finished rivers {start_index} to {end_index}')
     return
 
 
 if __name__ == '__main__':
-    step_size = base_step_size * 24 if resolution == 'hourly' else base_step_size
-    jobs = list(range(0, n_rivers, step_size))
+    with xr.open_zarr(discharge_zarr) as ds:
+        n_rivers = ds['river_id'].shape[0]
+    # the daily and hourly runs fill different variables of the same store, so only the first run creates it
+    if not os.path.exists(fdc_zarr):
+        create_fdc_store()
+    jobs = list(range(0, n_rivers, rivers_per_job))
 
     # Process chunks in parallel with timeout
-    with Pool(80) as p:
+    with fork.Pool(80) as p:
         for job in jobs:
             p.apply_async(hourly_chunk_to_fdcs, args=(job,))
         p.close()
         p.join()
-
-import xarray as xr
-from concurrent.futures import ThreadPoolExecutor as ThreadPool
-import dask
-
-if __name__ == '__main__':
-    n = 60
-    with dask.config.set(scheduler='threads', num_workers=n, pool=ThreadPool(n)):
-        ds = (
-            xr
-            .load_dataset('/mnt/zarr/fdc_hourly.nc')
-            .rename({
-                'fdc_daily_annual': 'fdc_daily',
-                'fdc_hourly_annual': 'fdc_hourly',
-            })
-        )
-        ds.attrs = {
-            "title": "River Forecast System v2 Monthly Retrospective Simulation",
-            "description": "Flow duration curves based on either hourly or daily average simulations, either by month or based on all data.",
-            "author": "Riley Chad Hales, PhD",
-            "creation_date": "2025-01-21",
-            "license": "CC-BY-SA 4.0",
-            "copyright": "2025",
-            "revision": "1",
-        }
-        (
-            ds
-            .chunk({
-                'p_exceed': 101,
-                'month': 12,
-                'river_id': 1000,
-            })
-            .to_zarr(
-                '/mnt/zarr/final/fdc.zarr',
-                mode='w',
-                zarr_format=2,
-                consolidated=True,
-                # encoding={
-                #     var: {'compressor': {'id': 'zstd', 'level': 5}} for var in ds.data_vars
-                # },
-                compute=True,
-            )
-        )
-
-# xr.open_zarr('/mnt/zarr/fdc_daily.zarr').to_netcdf('/mnt/fdc_daily.nc')
-# xr.open_zarr('/mnt/zarr/fdc_hourly.zarr').to_netcdf('/mnt/fdc_hourly.nc')
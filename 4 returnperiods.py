@@ -1,89 +1,151 @@
-from multiprocessing import Pool
+import os
 
 import numpy as np
-import pandas as pd
-import requests
-import datetime
 import xarray as xr
-from scipy.stats import pearson3, kurtosis
-from scipy.stats import weibull_min
+from scipy.special import gamma
+from scipy.stats import pearson3
+
+from instrument import instrumented
+from scheduler import fork
+from zarr_stores import create_variables_store, open_variable
 
-# Open dataset without Dask for direct loading
 return_periods = np.array([2, 5, 10, 25, 50, 100])
-# dataset = "/Users/rchales/data/maximums.zarr"
-rechunked = "/Users/rchales/data/maximums_rechunked.zarr"
+maximums_zarr = '/mnt/zarr/final/maximums.zarr'
+return_periods_zarr = '/mnt/zarr/final/return-periods.zarr'
+rivers_per_job = 50_000  # a multiple of the river_id chunks of both stores, bounds the memory of each worker
+return_periods_chunks = {'return_period': -1, 'river_id': rivers_per_job}
+# e.g. {'return_period': -1, 'river_id': rivers_per_job} with 1_000 river_id chunks: zarr v3 with one shard file per job
+return_periods_shards = None
+return_periods_dtype = 'float64'  # 'float32' halves the store but drops the 3rd decimal above about 8,000 m3/s
+n_workers = 24
+distributions = ['gumbel', 'logpearson3', 'gev']
+kfactors_file = '/mnt/zarr/final/pearson3-kfactors.nc'
+kfactor_skews = np.round(np.arange(-10, 10.0005, .001), 3)  # skew beyond +-10 is clipped to the edge of the table
+kfactor_tolerance = 1e-4  # largest allowed error of an interpolated frequency factor
+kfactors = None  # (skew, return_period) table from read_kfactors
 
 
-# dataset = '/home/ubuntu/maximums.zarr'
-# rechunked = '/home/ubuntu/maximums_rechunked.zarr'
+def compute_gumbel_rp(values):
+    # values is (year, river_id), returns (return_period, river_id)
+    std = np.nanstd(values, axis=0)
+    xbar = np.nanmean(values, axis=0)
+    rps = np.array(
+        [np.round(-np.log(-np.log(1 - (1 / rp))) * std * .7797 + xbar - (.45 * std), 2) for rp in return_periods])
+    return rps.round(3)
 
 
-def compute_lp3_rp(series):
-    values = np.log10(series + 1)
-    params = pearson3.fit(values)
-    rps = np.power(10, [pearson3.ppf(1 - 1 / yr, *params) for yr in return_periods])
-    return pd.Series(rps, index=return_periods, name=series.name)
+def compute_logpearson3_rp(values):
+    n = values.shape[0]
+    logx = np.log10(values + 1)
+    mean = np.nanmean(logx, axis=0)
+    std = np.nanstd(logx, axis=0)
+    skew = (n * np.power(logx - mean, 3).sum(axis=0)) / ((n - 1) * (n - 2) * np.power(std, 3))
+    skew = np.clip(skew, kfactor_skews[0], kfactor_skews[-1])
+    kt = np.array([np.interp(skew, kfactor_skews, kfactors[:, i]) for i in range(return_periods.shape[0])])
+    return np.power(10, mean + std * kt).round(3)
 
 
-def compute_weibull_rp(series):
-    params = weibull_min.fit(series)
-    rps = [weibull_min.ppf(1 - 1 / yr, *params) for yr in return_periods]
-    return pd.Series(rps, index=return_periods, name=series.name)
+def verify_kfactors(table) -> float:
+    """
+    Largest error of linear interpolation in the table against pearson3.ppf, evaluated halfway between the grid points
+    where the interpolation error is largest. Raises a ValueError if it exceeds kfactor_tolerance.
+    """
+    midpoints = (kfactor_skews[:-1] + kfactor_skews[1:]) / 2
+    error = 0
+    for i, yr in enumerate(return_periods):
+        exact = pearson3.ppf(1 - 1 / yr, midpoints)
+        error = max(error, np.abs(np.interp(midpoints, kfactor_skews, table[:, i]) - exact).max())
+    if error > kfactor_tolerance:
+        raise ValueError(f'pearson3 frequency factor table error {error} exceeds {kfactor_tolerance}')
+    return error
 
 
-def compute_gumbel_rp(df):
-    std = np.nanstd(df.values, axis=1)
-    xbar = np.nanmean(df.values, axis=1)
-    rps = np.array(
-        [np.round(-np.log(-np.log(1 - (1 / rp))) * std * .7797 + xbar - (.45 * std), 2) for rp in return_periods])
-    rps = pd.DataFrame(rps, index=return_periods, columns=df.index).round(3)
+def read_kfactors():
+    """
+    Pearson type III frequency factors for each skew in kfactor_skews and each return period, read from kfactors_file
+    or computed with pearson3.ppf and verified once and saved there if the file is missing or has other return periods.
+    """
+    if os.path.exists(kfactors_file):
+        with xr.open_dataset(kfactors_file) as ds:
+            same_skews = np.array_equal(ds['skew'].values, kfactor_skews)
+            if same_skews and set(return_periods) <= set(ds['return_period'].values):
+                return ds['kfactor'].sel(return_period=return_periods).values
+    table = np.array([pearson3.ppf(1 - 1 / yr, kfactor_skews) for yr in return_periods]).T
+    error = verify_kfactors(table)
+    print(f'computed pearson3 frequency factors, largest interpolation error {error:.2e}')
     (
         xr
         .Dataset(
-            {'gumbel': (['return_period', 'river_id'], rps.values)},
-            coords={'river_id': rps.columns, 'return_period': return_periods}
+            {'kfactor': (['skew', 'return_period'], table)},
+            coords={'skew': kfactor_skews, 'return_period': return_periods},
+            attrs={'max_interpolation_error': error},
         )
-        .to_netcdf('return_periods_gumbel.nc')
+        .to_netcdf(kfactors_file)
     )
+    return table
 
 
-def compute_logpearson3_rp(df):
-    n = df.shape[1]
-    logx = np.log10(df.values + 1)
-    mean = np.nanmean(logx, axis=1).reshape(-1, 1)
-    std = np.nanstd(logx, axis=1)
-    skew = (n * np.power(logx - mean, 3).sum(axis=1)) / ((n - 1) * (n - 2) * np.power(std, 3))
-    kt = np.array([pearson3.ppf(1 - 1 / yr, skew) for yr in return_periods]).T
-    rps = np.power(10, mean + std.reshape(-1, 1) * kt).T
-    rps = pd.DataFrame(rps, index=return_periods, columns=df.index).round(3)
-    (
-        xr
-        .Dataset(
-            {'logpearson3': (['return_period', 'river_id'], rps.values)},
-            coords={'river_id': rps.columns, 'return_period': return_periods}
-        )
-        .to_netcdf('return_periods_lp3.nc')
-    )
+def compute_gev_rp(values):
+    """
+    Generalized extreme value fit of every river at once from the sample L-moments (Hosking, 1985). A shape parameter
+    near 0 uses the Gumbel limit of the quantile function.
+    """
+    n = values.shape[0]
+    x = np.sort(values, axis=0)
+    j = np.arange(n).reshape(-1, 1)
+    b0 = x.mean(axis=0)
+    b1 = (j / (n - 1) * x).mean(axis=0)
+    b2 = (j * (j - 1) / ((n - 1) * (n - 2)) * x).mean(axis=0)
+    l1 = b0
+    l2 = 2 * b1 - b0
+    t3 = (6 * b2 - 6 * b1 + b0) / l2
+    c = 2 / (3 + t3) - np.log(2) / np.log(3)
+    k = 7.8590 * c + 2.9554 * np.power(c, 2)
+    gumbel_limit = np.abs(k) < 1e-6
+    k = np.where(gumbel_limit, 1e-6, k)
+    alpha = l2 * k / ((1 - np.power(2, -k)) * gamma(1 + k))
+    xi = l1 - alpha * (1 - gamma(1 + k)) / k
+    rps = []
+    for yr in return_periods:
+        y = -np.log(1 - 1 / yr)
+        rps.append(np.where(
+            gumbel_limit,
+            l1 - .5772 * l2 / np.log(2) - l2 / np.log(2) * np.log(y),
+            xi + alpha / k * (1 - np.power(y, k)),
+        ))
+    return np.array(rps).round(3)
 
 
-if __name__ == '__main__':
-    ds = xr.open_zarr(rechunked)
+@instrumented('return-periods')
+def compute_block(r0) -> tuple:
+    maximums = open_variable(maximums_zarr, mode='r')
+    r1 = min(r0 + rivers_per_job, maximums.shape[1])
+    values = maximums[:, r0:r1].astype(np.float64)
+    results = {
+        'gumbel': compute_gumbel_rp(values),
+        'logpearson3': compute_logpearson3_rp(values),
+        'gev': compute_gev_rp(values),
+    }
+    for name in distributions:
+        open_variable(return_periods_zarr, name)[:, r0:r1] = results[name]
+    return r0, r1
 
-    df = pd.DataFrame(
-        ds['Q'].values.T,
-        index=ds['river_id'].values,
-        columns=ds['time'].values
-    )
-    jobs = range(df.shape[0])
-    compute_gumbel_rp(df)
-    compute_logpearson3_rp(df)
-    ds1 = xr.open_dataset('return_periods_gumbel.nc')
-    ds2 = xr.open_dataset('return_periods_lp3.nc')
-    ds1.merge(ds2).to_zarr(
-        'return-periods.zarr',
-        mode='w', zarr_format=2, consolidated=True,
-        encoding={
-            'gumbel': {'chunks': (6, 50_000), 'compressor': None},
-            'logpearson3': {'chunks': (6, 50_000), 'compressor': None}
-        }
+
+def create_return_periods_store(river_ids) -> None:
+    create_variables_store(
+        return_periods_zarr,
+        {name: (('return_period', 'river_id'), return_periods_dtype, {}) for name in distributions},
+        coords={'return_period': return_periods, 'river_id': river_ids},
+        chunks=return_periods_chunks,
+        shards=return_periods_shards,
     )
+
+
+if __name__ == '__main__':
+    kfactors = read_kfactors()
+    with xr.open_zarr(maximums_zarr) as ds:
+        river_ids = ds['river_id'].values
+    create_return_periods_store(river_ids)
+    with fork.Pool(n_workers) as p:
+        for r0, r1 in p.imap_unordered(compute_block, range(0, river_ids.shape[0], rivers_per_job)):
+            print(f'Finished rivers {r0} to {r1}')
@@ -1,46 +1,81 @@
-import numcodecs
+import numpy as np
 import pandas as pd
 import xarray as xr
 
-if __name__ == '__main__':
-    ds = (
-        xr
-        .open_zarr('/mnt/zarr/final/monthly-timeseries.zarr')
-        .resample(time='YE')
-        .mean()
-    )
+from rechunk import rechunk, write_layouts
+from zarr_stores import create_store, variable_encoding
+
+monthly_zarr = '/mnt/zarr/final/monthly-timeseries.zarr'
+timeseries_zarr = '/mnt/zarr/final/yearly-timeseries.zarr'
+timesteps_zarr = '/mnt/zarr/final/yearly-timesteps.zarr'
+timeseries_chunks = {'time': -1, 'river_id': 1_000}
+timesteps_chunks = {'time': 1, 'river_id': 2_500_000}
+# e.g. {'time': -1, 'river_id': 100_000} and {'time': 10, 'river_id': 2_500_000}: zarr v3 with the chunks grouped into
+# shard files, which the first-write blocks already span. the rechunk branch writes an unsharded timeseries store.
+timeseries_shards = None
+timesteps_shards = None
+timesteps_from = 'first-write'  # 'first-write': both layouts from the same blocks, 'rechunk': rechunk the timeseries
+memory_budget = 4 * 1024 ** 3  # bytes per rechunk worker
+rivers_per_read = 100_000  # first-write: monthly rivers averaged at once within each block
+
+
+def yearly_means(ds):
+    ds = ds.resample(time='YE').mean()
     times = ds['time'].values
     force_left_aligned_times = pd.to_datetime(times)
     force_left_aligned_times = [f'{year}-01-01' for year in force_left_aligned_times.year]
     force_left_aligned_times = pd.to_datetime(force_left_aligned_times)
-    (
-        ds
-        .assign_coords({'time': force_left_aligned_times})
-        .chunk({'time': -1, 'river_id': 1_000})
-        .to_zarr(
-            '/mnt/zarr/final/yearly-timeseries.zarr',
-            mode='w',
-            zarr_format=2,
-            compute=True,
-            consolidated=True,
-            encoding={
-                'Q': {'compressor': numcodecs.Blosc(cname='zstd', clevel=5, shuffle=numcodecs.Blosc.AUTOSHUFFLE)}
-            },
+    return ds.assign_coords({'time': force_left_aligned_times})
+
+
+def read_yearly_rivers(r0, r1):
+    with xr.open_zarr(monthly_zarr) as ds:
+        return np.concatenate([
+            yearly_means(ds.isel(river_id=slice(r, min(r + rivers_per_read, r1))))['Q'].values
+            for r in range(r0, r1, rivers_per_read)
+        ], axis=1)
+
+
+if __name__ == '__main__':
+    if timesteps_from == 'first-write':
+        with xr.open_zarr(monthly_zarr) as ds:
+            times = yearly_means(ds.isel(river_id=slice(0, 1)))['time'].values
+            river_ids = ds['river_id'].values
+            var_attrs = ds['Q'].attrs
+        layouts = (
+            (timeseries_zarr, timeseries_chunks, timeseries_shards),
+            (timesteps_zarr, timesteps_chunks, timesteps_shards),
+        )
+        for path, chunks, shards in layouts:
+            create_store(
+                path,
+                dims=('time', 'river_id'),
+                coords={'time': times, 'river_id': river_ids},
+                chunks=chunks,
+                var_attrs=var_attrs,
+                shards=shards,
+            )
+        write_layouts(read_yearly_rivers, river_ids.shape[0], [timeseries_zarr, timesteps_zarr], n_workers=24)
+    else:
+        (
+            yearly_means(xr.open_zarr(monthly_zarr))
+            .chunk(timeseries_chunks)
+            .to_zarr(
+                timeseries_zarr,
+                mode='w',
+                zarr_format=2,
+                compute=True,
+                consolidated=True,
+                encoding={'Q': variable_encoding('Q', 'float32')},
+            )
         )
-    )
-    # now read and rechunk that file to timesteps oriented
-    (
-        xr
-        .open_zarr('/mnt/zarr/final/yearly-timeseries.zarr')
-        .chunk({'time': 1, 'river_id': 2_500_000})
-        .to_zarr(
-            '/mnt/zarr/final/yearly-timesteps.zarr',
-            mode='w',
-            zarr_format=2,
-            compute=True,
-            consolidated=True,
-            encoding={
-                'Q': {'compressor': numcodecs.Blosc(cname='zstd', clevel=5, shuffle=numcodecs.Blosc.AUTOSHUFFLE)}
-            },
+        # now read and rechunk that file to timesteps oriented
+        rechunk(
+            timeseries_zarr,
+            timesteps_zarr,
+            timesteps_chunks,
+            memory_budget=memory_budget,
+            n_workers=24,
+            intermediate_path='/mnt/zarr/final/yearly-intermediate.zarr',
+            target_shards=timesteps_shards,
         )
-    )
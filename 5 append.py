@@ -0,0 +1,209 @@
+import os
+import runpy
+from glob import glob
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+from natsort import natsorted
+
+from rechunk import write_layouts
+from zarr_stores import create_store, extend_time, open_variable
+
+discharge_root = '/mnt/discharge'
+maxes_root = '/mnt/discharge/MAXES'
+final_root = '/mnt/zarr/final'
+n_workers = 24
+rivers_per_block = 100_000
+update_return_periods = True  # rerun 4 returnperiods.py (reads only maximums.zarr) when a year of maxima completes
+job_state = {}  # inputs of the block functions of the next write_layouts call
+
+# netcdf product name: (root of the per-vpu netcdfs, final stores appended along time)
+appended_products = {
+    'hourly': (discharge_root, ['hourly.zarr', ]),
+    'daily': (discharge_root, ['daily.zarr', ]),
+    'monthly': (discharge_root, ['monthly-timeseries.zarr', 'monthly-timesteps.zarr']),
+}
+# hourly.zarr and daily.zarr have one time chunk for the whole record, so rows appended to them would decode and
+# rewrite every chunk of the store on every append. their new rows go to a separate {name}-appended.zarr instead,
+# chunked by about a month so each append writes only its own rows and at most one partial chunk row before them.
+# readers concatenate the two stores along time. the monthly timeseries is extended in place: it gains one row a
+# month, which rewrites its last chunk row (1020 rows x 1000 rivers, about 4 MB a chunk) once per append.
+appended_stores = {
+    'hourly.zarr': ('hourly-appended.zarr', {'time': 744, 'river_id': 500}),
+    'daily.zarr': ('daily-appended.zarr', {'time': 31, 'river_id': 5_000}),
+}
+
+
+def netcdf_month(file) -> str:
+    # Q_{product}_{YYYYMM...}.nc
+    return os.path.basename(file).split('_')[-1][:6]
+
+
+def label_times(product, times):
+    # the monthly stores label each month with the first day of the following month (see 3 monthly.py)
+    times = pd.to_datetime(times)
+    if product == 'monthly':
+        return pd.to_datetime([f'{t.year}-{t.month:02d}-01' for t in times]) + pd.DateOffset(months=1)
+    return times
+
+
+def new_months(root, product, after) -> list:
+    """
+    Months with a netcdf for every vpu whose timesteps come after `after`, each as (month, [file per vpu])
+    """
+    vpus = [d for d in natsorted(glob(os.path.join(root, '*'))) if os.path.isdir(d)]
+    # only open the files of the last few months in the store and later
+    earliest = (after - pd.DateOffset(months=2)).strftime('%Y%m')
+    candidates = natsorted(glob(os.path.join(vpus[0], f'Q_{product}_*.nc')))
+    candidates = [netcdf_month(f) for f in candidates if netcdf_month(f) >= earliest]
+    months = []
+    for month in candidates:
+        files = [glob(os.path.join(vpu, f'Q_{product}_{month}*.nc')) for vpu in vpus]
+        if not all(files):
+            print(f'{product} {month} is missing for some vpus, stopping before it')
+            break
+        with xr.open_dataset(files[0][0]) as ds:
+            if label_times(product, ds['time'].values)[-1] <= after:
+                continue
+        months.append((month, [f[0] for f in files]))
+    return months
+
+
+def month_layout(files):
+    river_counts = []
+    for file in files:
+        with xr.open_dataset(file) as ds:
+            river_counts.append(ds['river_id'].shape[0])
+    return np.cumsum([0, ] + river_counts)
+
+
+def read_month_rivers(r0, r1):
+    # global rivers r0:r1 of one month from the per-vpu netcdfs that overlap them
+    files, offsets = job_state['files'], job_state['offsets']
+    pieces = []
+    for file, offset, end in zip(files, offsets[:-1], offsets[1:]):
+        if offset < r1 and end > r0:
+            a, b = max(r0, offset) - offset, min(r1, end) - offset
+            with xr.open_dataset(file) as ds:
+                pieces.append(ds['Q'].transpose('time', 'river_id')[:, a:b].values)
+    return np.concatenate(pieces, axis=1)
+
+
+def update_annual_max(r0, r1):
+    existing = open_variable(job_state['path'], mode='r')[job_state['row']:job_state['row'] + 1, r0:r1]
+    return np.fmax(existing, read_month_rivers(r0, r1).max(axis=0, keepdims=True))
+
+
+def mean_of_monthly_rows(r0, r1):
+    return np.nanmean(open_variable(job_state['path'], mode='r')[job_state['rows'], r0:r1], axis=0, keepdims=True)
+
+
+def year_row(path, year) -> int:
+    # the row labelled {year}-01-01 in a store of annual values, appended if the year is new
+    with xr.open_zarr(path) as ds:
+        years = pd.to_datetime(ds['time'].values).year
+    if year in years:
+        return int(np.flatnonzero(years == year)[0])
+    return extend_time(path, pd.to_datetime([f'{year}-01-01']))
+
+
+def append_product(product) -> list:
+    global job_state
+    root, stores = appended_products[product]
+    with xr.open_zarr(os.path.join(final_root, stores[0])) as ds:
+        after = pd.Timestamp(ds['time'].values[-1])
+        river_ids = ds['river_id'].values
+        var_attrs = ds['Q'].attrs
+    n_rivers = river_ids.shape[0]
+    paths = [os.path.join(final_root, appended_stores[s][0] if s in appended_stores else s) for s in stores]
+    if stores[0] in appended_stores and os.path.exists(paths[0]):
+        with xr.open_zarr(paths[0]) as ds:
+            after = pd.Timestamp(ds['time'].values[-1])
+    months = new_months(root, product, after)
+    for month, files in months:
+        offsets = month_layout(files)
+        if offsets[-1] != n_rivers:
+            raise ValueError(f'{product} {month} has {offsets[-1]} rivers but the store has {n_rivers}')
+        with xr.open_dataset(files[0]) as ds:
+            times = label_times(product, ds['time'].values)
+        if stores[0] in appended_stores and not os.path.exists(paths[0]):
+            # the first appended month creates the separate store
+            create_store(
+                paths[0], ('time', 'river_id'), {'time': times, 'river_id': river_ids},
+                chunks=appended_stores[stores[0]][1], var_attrs=var_attrs, growing_dims=('time', ),
+            )
+            start = 0
+        else:
+            start = [extend_time(path, times) for path in paths][0]
+        job_state = {'files': files, 'offsets': offsets}
+        write_layouts(
+            read_month_rivers, n_rivers, paths, n_workers,
+            time_slice=slice(start, start + len(times)), rivers_per_block=rivers_per_block,
+        )
+        print(f'Appended {product} {month}')
+    return [m for m, _ in months]
+
+
+def append_maximums() -> bool:
+    """
+    Fold new monthly maxima into the annual maximums. The store records the last month included in its attributes.
+    Returns True if a year of maxima was completed.
+    """
+    global job_state
+    path = os.path.join(final_root, 'maximums.zarr')
+    group = zarr.open_group(path, mode='r+')
+    with xr.open_zarr(path) as ds:
+        n_rivers = ds['river_id'].shape[0]
+        last_month = group.attrs.get('last_month', f'{pd.to_datetime(ds["time"].values[-1]).year}12')
+    months = new_months(maxes_root, 'monmax', pd.Timestamp(last_month + '01') + pd.offsets.MonthEnd(0))
+    completed_year = False
+    for month, files in months:
+        row = year_row(path, int(month[:4]))
+        job_state = {'files': files, 'offsets': month_layout(files), 'path': path, 'row': row}
+        write_layouts(
+            update_annual_max, n_rivers, [path, ], n_workers,
+            time_slice=slice(row, row + 1), rivers_per_block=rivers_per_block,
+        )
+        group.attrs['last_month'] = month
+        zarr.consolidate_metadata(path)
+        completed_year = completed_year or month.endswith('12')
+        print(f'Updated annual maximums with {month}')
+    return completed_year
+
+
+def update_yearly(years) -> None:
+    global job_state
+    monthly_path = os.path.join(final_root, 'monthly-timeseries.zarr')
+    paths = [os.path.join(final_root, s) for s in ('yearly-timeseries.zarr', 'yearly-timesteps.zarr')]
+    with xr.open_zarr(monthly_path) as ds:
+        monthly_years = pd.to_datetime(ds['time'].values).year
+        n_rivers = ds['river_id'].shape[0]
+    for year in years:
+        rows = np.flatnonzero(monthly_years == year)
+        row = [year_row(p, year) for p in paths][0]
+        job_state = {'path': monthly_path, 'rows': slice(rows[0], rows[-1] + 1)}
+        write_layouts(
+            mean_of_monthly_rows, n_rivers, paths, n_workers,
+            time_slice=slice(row, row + 1), rivers_per_block=rivers_per_block,
+        )
+        print(f'Updated yearly means for {year}')
+
+
+if __name__ == '__main__':
+    # run after 1 volumes.py and 2 route.py (with append = True) have produced the new months for every vpu
+    for product in appended_products:
+        appended = append_product(product)
+        if product == 'monthly' and appended:
+            with xr.open_zarr(os.path.join(final_root, 'monthly-timeseries.zarr')) as ds:
+                labels = pd.to_datetime(ds['time'].values)[-len(appended):]
+            update_yearly(sorted(set(labels.year)))
+
+    if append_maximums() and update_return_periods:
+        print('recomputing return periods from the annual maximums')
+        runpy.run_path('4 returnperiods.py', run_name='__main__')
+
+    # the flow duration curves describe the fixed earliest_date to latest_date reference period in 4 fdc.py, so new
+    # months only change them if that period is moved, which requires rerunning 4 fdc.py
+    print('completed')
@@ -0,0 +1,383 @@
+"""
+Times the volumes, routing, aggregation, zarr assembly, FDC and return period stages on synthetic inputs written to
+bench_root, so performance changes can be measured on a laptop before a full run. The inputs are generated once at the
+scale set below: an ERA5 like hourly runoff grid, and for each vpu the grid weights, routing parameters and a tree
+shaped connectivity.
+
+    python benchmark.py                 # every stage, in order
+    python benchmark.py route assemble  # only these stages, using the outputs a previous run left in bench_root
+
+Each stage runs in its own process and reports its throughput in river-hours of simulation per second and the peak
+RSS of that process or of any of its pool workers. Results are appended to {bench_root}/results.jsonl and every stage
+is logged by instrument.measure to {bench_root}/jobs.jsonl.
+"""
+import inspect
+import json
+import os
+import resource
+import runpy
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import instrument
+from catchment_volumes import calc_catchment_volumes
+from muskingum import read_network, route_blocks, route_blocks_split
+from scheduler import fork
+from zarr_stores import assemble_global_store, create_store, discharge_attrs, open_variable
+
+bench_root = '/tmp/rfs-benchmark'
+n_vpus = 4
+rivers_per_vpu = 25_000
+cells_per_river = 3  # grid cells in each river's catchment
+runoff_months = ['2020-01', '2020-02']  # one hourly runoff file per month
+n_lat, n_lon = 120, 240  # 0.25 degree runoff grid
+outflow_chunks = {'time': -1, 'river_id': 500}  # chunks of the routed outflows of each vpu and of the assembled store
+assembled_shards = {'time': -1, 'river_id': 10_000}  # shards of the assemble-sharded stage (zarr v3)
+fdc_rivers = 10_000
+fdc_years = 30  # years of synthetic daily discharge for the fdc stage
+maxima_years = 85  # years of synthetic annual maxima for the return periods stage
+n_workers = 4  # pool size of the stages that use one, and routing processes of route-split
+seed = 42
+stage_functions = {}  # job functions of the loaded stage scripts, see stage_job
+
+vpus = [f'{i + 1:03d}' for i in range(n_vpus)]
+configs_root = os.path.join(bench_root, 'configs')
+runoffs_dir = os.path.join(bench_root, 'era5')
+volumes_dir = os.path.join(bench_root, 'volumes')
+outflows_dir = os.path.join(bench_root, 'outflows')
+
+
+def runoff_file(month) -> str:
+    return os.path.join(runoffs_dir, f'era5_{month.replace("-", "")}.nc')
+
+
+def outflow_store(vpu) -> str:
+    return os.path.join(outflows_dir, f'{vpu}.zarr')
+
+
+def open_outflows(vpu):
+    return xr.open_zarr(outflow_store(vpu))
+
+
+def synthetic_network(n, rng):
+    """
+    Rivers in routing order where each river drains into one a few places further down the order and about 1 in 100
+    is an outlet, which gives a forest of trees with long main stems and many short tributaries.
+    """
+    downstream = np.arange(n) + rng.geometric(0.2, n)
+    downstream[(downstream >= n) | (rng.random(n) < 0.01)] = -1
+    return downstream
+
+
+def write_vpu_configs(i, vpu) -> None:
+    configs = os.path.join(configs_root, vpu)
+    os.makedirs(configs, exist_ok=True)
+    rng = np.random.default_rng(seed + i)
+    river_ids = (i + 1) * 10_000_000 + np.arange(rivers_per_vpu)
+    downstream = synthetic_network(rivers_per_vpu, rng)
+    pd.DataFrame({
+        'river_id': river_ids,
+        'k': rng.uniform(1_800, 36_000, rivers_per_vpu),
+        'x': rng.uniform(0, .3, rivers_per_vpu),
+    }).to_parquet(os.path.join(configs, 'routing_parameters.parquet'))
+    pd.DataFrame({
+        'river_id': river_ids,
+        'downstream_river_id': np.where(downstream >= 0, river_ids[downstream.clip(0)], -1),
+    }).to_parquet(os.path.join(configs, 'connectivity.parquet'))
+
+    # each vpu covers a band of longitudes and each catchment a few neighboring cells
+    band = n_lon // n_vpus
+    y = rng.integers(1, n_lat - 1, rivers_per_vpu).repeat(cells_per_river)
+    x = (i * band + rng.integers(1, band - 1, rivers_per_vpu)).repeat(cells_per_river)
+    y += rng.integers(-1, 2, y.shape[0])
+    x += rng.integers(-1, 2, x.shape[0])
+    (
+        xr
+        .Dataset({
+            'river_id': ('index', river_ids.repeat(cells_per_river)),
+            'x_index': ('index', x),
+            'y_index': ('index', y),
+            'area_sqm': ('index', rng.uniform(1e6, 5e7, x.shape[0])),
+        })
+        .to_netcdf(os.path.join(configs, f'gridweights_ERA5_{vpu}.nc'))
+    )
+
+
+def write_runoff(month, rng) -> None:
+    times = pd.date_range(month, pd.Period(month).end_time.floor('h'), freq='h')
+    # runoff depths in m per hour, mostly near zero with occasional storms
+    depths = rng.gamma(.3, 3e-4, (times.shape[0], n_lat, n_lon)).astype(np.float32)
+    (
+        xr
+        .Dataset(
+            {'ro': (('valid_time', 'latitude', 'longitude'), depths)},
+            coords={
+                'valid_time': times,
+                'latitude': 90 - .25 * np.arange(n_lat),
+                'longitude': .25 * np.arange(n_lon),
+            },
+        )
+        .to_netcdf(runoff_file(month))
+    )
+
+
+def generate_inputs() -> None:
+    # inputs that already exist are kept so repeated runs measure the same data
+    os.makedirs(runoffs_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for month in runoff_months:
+        if not os.path.exists(runoff_file(month)):
+            print(f'writing synthetic runoff for {month}')
+            write_runoff(month, rng)
+    for i, vpu in enumerate(vpus):
+        if not os.path.exists(os.path.join(configs_root, vpu, f'gridweights_ERA5_{vpu}.nc')):
+            print(f'writing synthetic configs for vpu {vpu}')
+            write_vpu_configs(i, vpu)
+
+
+def read_volumes(vpu) -> list:
+    blocks = []
+    for month in runoff_months:
+        with np.load(os.path.join(volumes_dir, f'{vpu}_{month}.npz')) as f:
+            blocks.append(pd.DataFrame(f['volumes'], index=pd.to_datetime(f['times']), columns=f['river_ids']))
+    return blocks
+
+
+def stage_job(args):
+    # jobs are sent by name like in run.py
+    name, job = args
+    return stage_functions[name](job)
+
+
+def load_stage(script, *names) -> dict:
+    """
+    Load a stage script without its main block and register the named job functions for stage_job. Returns the
+    script's module globals, which its functions read when called, so paths set in them point the stage at bench_root.
+    """
+    namespace = runpy.run_path(script)
+    for name in names:
+        stage_functions[name] = namespace[name]
+    return inspect.unwrap(namespace[names[0]]).__globals__
+
+
+# each stage prepares its inputs and returns (the timed part, the river-hours it covers, a function saving its outputs
+# for later stages or None)
+
+
+def bench_volumes():
+    def run():
+        for vpu in vpus:
+            for month in runoff_months:
+                df = calc_catchment_volumes(os.path.join(configs_root, vpu), runoff_file(month))
+                results.append((vpu, month, df))
+
+    def save():
+        os.makedirs(volumes_dir, exist_ok=True)
+        for vpu, month, df in results:
+            np.savez(
+                os.path.join(volumes_dir, f'{vpu}_{month}.npz'),
+                volumes=df.values, times=df.index.values, river_ids=df.columns.values,
+            )
+
+    results = []
+    hours = sum(pd.Period(m).days_in_month * 24 for m in runoff_months)
+    return run, n_vpus * rivers_per_vpu * hours, save
+
+
+def bench_route():
+    def run():
+        for vpu, network, blocks in inputs:
+            n = network[0].shape[0]
+            # each block's outflows are only valid until the next one is routed
+            outflows[vpu] = pd.concat([
+                df.copy() for df, _, _ in route_blocks(network, blocks, np.zeros(n), np.zeros(n))
+            ])
+
+    def save():
+        for vpu, df in outflows.items():
+            write_outflows(vpu, df)
+
+    inputs = [(vpu, read_network(*vpu_network_files(vpu)), read_volumes(vpu)) for vpu in vpus]
+    outflows = {}
+    units = sum(b.shape[0] * b.shape[1] for _, _, blocks in inputs for b in blocks)
+    return run, units, save
+
+
+def bench_route_split():
+    def run():
+        for _ in route_blocks_split(network, blocks, np.zeros(n), np.zeros(n), n_workers=n_workers):
+            pass
+
+    network = read_network(*vpu_network_files(vpus[0]))
+    n = network[0].shape[0]
+    blocks = read_volumes(vpus[0])
+    return run, sum(b.shape[0] * b.shape[1] for b in blocks), None
+
+
+def bench_aggregate():
+    def run():
+        for df in outflows:
+            aggregate_outflows(df, ['daily', 'monthly', 'monmax'])
+
+    aggregate_outflows = runpy.run_path('2 route.py')['aggregate_outflows']
+    outflows = []
+    for vpu in vpus:
+        with open_outflows(vpu) as ds:
+            outflows.append(ds['Q'].to_pandas())
+    return run, sum(df.shape[0] * df.shape[1] for df in outflows), None
+
+
+def bench_assemble(copy_chunks=False, shards=None):
+    def run():
+        assemble_global_store(
+            open_outflows, vpus, os.path.join(bench_root, 'assembled.zarr'), outflow_chunks, {}, n_workers,
+            rivers_per_write=5_000, vpu_store=outflow_store if copy_chunks else None, shards=shards,
+        )
+
+    with open_outflows(vpus[0]) as ds:
+        n_times = ds['time'].shape[0]
+    return run, n_times * n_vpus * rivers_per_vpu, None
+
+
+def bench_fdc():
+    def run():
+        fdc_stage['create_fdc_store']()
+        with fork.Pool(n_workers) as p:
+            p.map(stage_job, [('hourly_chunk_to_fdcs', i) for i in range(0, fdc_rivers, fdc_stage['rivers_per_job'])])
+
+    times = pd.date_range(f'{2024 - fdc_years + 1}-01-01', '2024-12-31', freq='D')
+    path = os.path.join(bench_root, 'daily.zarr')
+    if not os.path.exists(path):
+        write_synthetic_discharge(path, times)
+    fdc_stage = load_stage('4 fdc.py', 'hourly_chunk_to_fdcs')
+    fdc_stage.update(
+        resolution='daily', discharge_zarr=path, fdc_zarr=os.path.join(bench_root, 'fdc.zarr'), n_rivers=fdc_rivers,
+        earliest_date=str(times[0].date()), latest_date=str(times[-1].date()), rivers_per_sort=1000,
+    )
+    return run, fdc_rivers * times.shape[0] * 24, None
+
+
+def bench_return_periods():
+    def run():
+        rp_stage['create_return_periods_store'](river_ids)
+        with fork.Pool(n_workers) as p:
+            p.map(stage_job, [('compute_block', i) for i in range(0, river_ids.shape[0], rp_stage['rivers_per_job'])])
+
+    rp_stage = load_stage('4 returnperiods.py', 'compute_block')
+    rp_stage.update(
+        maximums_zarr=os.path.join(bench_root, 'maximums.zarr'),
+        return_periods_zarr=os.path.join(bench_root, 'return-periods.zarr'),
+        kfactors_file=os.path.join(bench_root, 'pearson3-kfactors.nc'),
+    )
+    river_ids = np.arange(n_vpus * rivers_per_vpu)
+    if not os.path.exists(rp_stage['maximums_zarr']):
+        rng = np.random.default_rng(seed)
+        scale = rng.lognormal(2, 1.5, river_ids.shape[0])
+        maximums = (rng.gumbel(1, .3, (maxima_years, river_ids.shape[0])) * scale).astype(np.float32)
+        times = pd.date_range(f'{2024 - maxima_years + 1}-01-01', periods=maxima_years, freq='YS')
+        create_store(rp_stage['maximums_zarr'], ('time', 'river_id'), {'time': times, 'river_id': river_ids},
+                     chunks={'time': -1, 'river_id': 1_000})
+        open_variable(rp_stage['maximums_zarr'])[:] = maximums
+    # the frequency factor table is computed once and cached, like in a real run
+    rp_stage['kfactors'] = rp_stage['read_kfactors']()
+    return run, river_ids.shape[0] * maxima_years * 8760, None
+
+
+def vpu_network_files(vpu) -> tuple:
+    configs = os.path.join(configs_root, vpu)
+    return os.path.join(configs, 'routing_parameters.parquet'), os.path.join(configs, 'connectivity.parquet')
+
+
+def write_outflows(vpu, df) -> None:
+    create_store(
+        outflow_store(vpu),
+        dims=('time', 'river_id'),
+        coords={'time': df.index, 'river_id': df.columns.values},
+        chunks=outflow_chunks,
+        var_attrs={**discharge_attrs, 'aggregation_method': 'mean'},
+    )
+    open_variable(outflow_store(vpu))[:] = df.values
+
+
+def write_synthetic_discharge(path, times) -> None:
+    # lognormal daily discharge with a seasonal cycle, written in blocks of rivers
+    rng = np.random.default_rng(seed)
+    create_store(path, ('time', 'river_id'), {'time': times, 'river_id': np.arange(fdc_rivers)},
+                 chunks={'time': -1, 'river_id': 1_000}, var_attrs=discharge_attrs)
+    array = open_variable(path)
+    season = 1 + .5 * np.sin(2 * np.pi * times.dayofyear.values / 365).reshape(-1, 1)
+    for a in range(0, fdc_rivers, 1_000):
+        b = min(a + 1_000, fdc_rivers)
+        scale = rng.lognormal(2, 1.5, b - a)
+        array[:, a:b] = (rng.lognormal(0, .8, (times.shape[0], b - a)) * season * scale).astype(np.float32)
+
+
+stages = {
+    'volumes': bench_volumes,
+    'route': bench_route,
+    'route-split': bench_route_split,
+    'aggregate': bench_aggregate,
+    'assemble': bench_assemble,
+    'assemble-copy': lambda: bench_assemble(copy_chunks=True),
+    'assemble-sharded': lambda: bench_assemble(shards=assembled_shards),
+    'fdc': bench_fdc,
+    'return-periods': bench_return_periods,
+}
+
+
+def run_stage(stage, results) -> None:
+    """
+    Prepare and time one stage in this process, then save its outputs for the stages after it. The peak RSS is the
+    larger of this process and its largest pool worker, and includes the stage's inputs.
+    """
+    run, units, save = stages[stage]()
+    start = time.time()
+    instrument.measure(stage, 'benchmark', run, units=units)
+    seconds = time.time() - start
+    peak_kb = max(resource.getrusage(r).ru_maxrss for r in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+    if save is not None:
+        save()
+    results.put({
+        'stage': stage,
+        'seconds': round(seconds, 3),
+        'river_hours': units,
+        'river_hours_per_s': round(units / seconds),
+        'peak_rss_mb': round(peak_kb / 1024, 1),
+    })
+
+
+if __name__ == '__main__':
+    selected = sys.argv[1:] or list(stages)
+    unknown = [s for s in selected if s not in stages]
+    if unknown:
+        raise ValueError(f'unknown stages {unknown}, choose from {list(stages)}')
+    os.makedirs(bench_root, exist_ok=True)
+    instrument.log_file = os.path.join(bench_root, 'jobs.jsonl')
+    generate_inputs()
+
+    rows = []
+    results = fork.Queue()
+    for stage in selected:
+        # a new process per stage so each peak RSS is the stage's own and pool workers can be started by any stage
+        p = fork.Process(target=run_stage, args=(stage, results))
+        p.start()
+        p.join()
+        if p.exitcode:
+            print(f'{stage} failed, the stages after it may be missing their inputs')
+            continue
+        rows.append(results.get())
+        print(f'finished {stage} in {rows[-1]["seconds"]:.1f} s')
+
+    print(f'{"stage":<18}{"seconds":>10}{"river-hours":>16}{"river-hours/s":>16}{"peak MB":>10}')
+    for row in rows:
+        print(f'{row["stage"]:<18}{row["seconds"]:>10.1f}{row["river_hours"]:>16,}{row["river_hours_per_s"]:>16,}'
+              f'{row["peak_rss_mb"]:>10.0f}')
+    scale = {'n_vpus': n_vpus, 'rivers_per_vpu': rivers_per_vpu, 'runoff_months': runoff_months,
+             'fdc_rivers': fdc_rivers, 'fdc_years': fdc_years, 'maxima_years': maxima_years, 'n_workers': n_workers}
+    with open(os.path.join(bench_root, 'results.jsonl'), 'a') as f:
+        for row in rows:
+            f.write(json.dumps({'time': time.time(), **scale, **row}) + '\n')
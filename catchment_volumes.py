@@ -0,0 +1,74 @@
+"""
+Catchment volumes from ERA5 runoff depths and the grid weight tables in each vpu's routing configs directory.
+Importable by the numbered scripts (which cannot be imported because of their file names).
+"""
+import os
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy import sparse
+
+weight_tables_per_worker = 4  # parsed weight tables kept in memory by each worker (LRU)
+
+
+@lru_cache(maxsize=weight_tables_per_worker)
+def read_weight_table(configs):
+    """
+    Parse a vpu's grid weights table once per worker. Returns the river ids in routing order, the (y, x) indices of
+    the unique runoff grid cells used by the vpu, the bounding box of those cells on the runoff grid, and a sparse
+    (river, cell) matrix of cell areas so that catchment volumes = runoff depths @ matrix.T
+    """
+    vpu = os.path.basename(configs)
+    river_ids = pd.read_parquet(os.path.join(configs, 'routing_parameters.parquet'), columns=['river_id'])['river_id']
+    with xr.open_dataset(os.path.join(configs, f'gridweights_ERA5_{vpu}.nc')) as wt:
+        table_ids = wt['river_id'].values
+        y_index = wt['y_index'].values.astype(np.int64)
+        x_index = wt['x_index'].values.astype(np.int64)
+        areas = wt['area_sqm'].values.astype(np.float64)
+
+    y_min, y_max, x_min, x_max = y_index.min(), y_index.max(), x_index.min(), x_index.max()
+    bbox = (slice(y_min, y_max + 1), slice(x_min, x_max + 1))
+    # cells are numbered within the bounding box so each month only reads the part of the grid the vpu covers
+    local_cells = (y_index - y_min) * (x_max - x_min + 1) + (x_index - x_min)
+    unique_cells, cell_columns = np.unique(local_cells, return_inverse=True)
+    rows = pd.Index(river_ids.values).get_indexer(table_ids)
+    if (rows < 0).any():
+        raise ValueError(f'{vpu} weight table contains river ids not found in routing_parameters.parquet')
+    matrix = sparse.csr_matrix((areas, (rows, cell_columns)), shape=(river_ids.shape[0], unique_cells.shape[0]))
+    cells_y, cells_x = np.divmod(unique_cells, x_max - x_min + 1)
+    return river_ids.values, cells_y, cells_x, bbox, matrix
+
+
+def calc_catchment_volumes(configs, runoff_file) -> pd.DataFrame:
+    river_ids, cells_y, cells_x, bbox, matrix = read_weight_table(configs)
+    with xr.open_dataset(runoff_file) as ds:
+        depths = ds['ro'].isel(latitude=bbox[0], longitude=bbox[1]).values[:, cells_y, cells_x]
+        times = ds['valid_time'].values
+    depths = np.nan_to_num(depths, nan=0)
+    depths[depths < 0] = 0  # force positive runoff
+    return pd.DataFrame(matrix.dot(depths.T).T, index=pd.to_datetime(times), columns=river_ids)
+
+
+def build_stacked_weights(configs_dirs, n_lon):
+    """
+    Stack every vpu's weights into a single (all rivers, grid cells) matrix whose columns are the union of the ERA5
+    cells used by any vpu. Row offsets locate each vpu's rivers within the stacked matrix.
+    """
+    river_ids, cells, matrices = [], [], []
+    for configs in configs_dirs:
+        vpu_river_ids, cells_y, cells_x, bbox, matrix = read_weight_table(configs)
+        river_ids.append(vpu_river_ids)
+        cells.append((cells_y + bbox[0].start) * n_lon + (cells_x + bbox[1].start))
+        matrices.append(matrix)
+    grid_cells = np.unique(np.concatenate(cells))
+    matrices = [
+        sparse.csr_matrix(
+            (m.data, np.searchsorted(grid_cells, c)[m.indices], m.indptr),
+            shape=(m.shape[0], grid_cells.shape[0])
+        )
+        for m, c in zip(matrices, cells)
+    ]
+    offsets = np.cumsum([0, ] + [m.shape[0] for m in matrices])
+    return configs_dirs, river_ids, grid_cells, sparse.vstack(matrices, format='csr'), offsets
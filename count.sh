@@ -5,49 +5,55 @@ discharge_root="/mnt/discharge"
 zarr_root="/mnt/zarr/hourly"
 final_root="/mnt/zarr/final"
 configs_root="/home/ubuntu/routing_configs"
+manifest="/home/ubuntu/manifest.sqlite"
 
 discharge_root="/mnt/discharge/MAXES"
 
 if [ "$1" == "-d" ] || [ "$1" == "-v" ]; then
+  # per vpu progress from the job manifest: months of volumes (1020 per vpu) or routed decades (9 per vpu)
   if [ "$1" == "-d" ]; then
-    selected_directory=$discharge_root
-    search_string="Q_hourly*.nc"
-    search_string="Q_monmax*.nc"
+    stage="route"
+    per_vpu=9
   elif [ "$1" == "-v" ]; then
-    selected_directory=$volumes_root
-    search_string="volumes_*.nc"
+    stage="volumes"
+    per_vpu=1020
   fi
-  find "$selected_directory" -type d | sort | while read -r dir; do
-      count=$(find "$dir" -maxdepth 1 -type f -name "$search_string" | wc -l)
-      if [ $count -eq 1020 ]; then
-          echo "$dir: $count -- Complete"
-      else
-          echo "$dir: $count"
-      fi
-  done
-  total_files=$(find $selected_directory -name "$search_string" | wc -l)
-  total_files_expected=127500
-  percent_complete=$(echo "scale=5; $total_files / $total_files_expected * 100" | bc)
-  echo "Total Files: $total_files"
-  echo "Total Files for Completion: $total_files_expected"
+  sqlite3 -separator ': ' "$manifest" "
+    SELECT substr(job, 1, instr(job, '/') - 1) AS vpu,
+           count(*) || CASE WHEN count(*) = $per_vpu THEN ' -- Complete' ELSE '' END
+    FROM jobs WHERE stage = '$stage' AND state = 'done' GROUP BY vpu ORDER BY vpu"
+  expected_vpus=$(find "$configs_root" -mindepth 1 -maxdepth 1 -type d | wc -l)
+  total_jobs=$(sqlite3 "$manifest" "SELECT count(*) FROM jobs WHERE stage = '$stage' AND state = 'done'")
+  total_jobs_expected=$((expected_vpus * per_vpu))
+  percent_complete=$(echo "scale=5; $total_jobs / $total_jobs_expected * 100" | bc)
+  echo "Total Jobs: $total_jobs"
+  echo "Total Jobs for Completion: $total_jobs_expected"
   echo "Percent Complete: $percent_complete"
 
 elif [ "$1" == "-z" ]; then
-# get a list of all the directories in configs_root
-  find "$configs_root" -type d | sort | while read -r dir; do
-    if [ -d "$zarr_root/$(basename $dir).zarr" ]; then
+  # vpus converted (or routed straight) to hourly zarr, from the job manifest
+  find "$configs_root" -mindepth 1 -maxdepth 1 -type d | sort | while read -r dir; do
+    vpu=$(basename "$dir")
+    state=$(sqlite3 "$manifest" "SELECT state FROM jobs WHERE stage = 'hourly-zarr' AND job = '$vpu'")
+    if [ "$state" == "done" ]; then
       echo "$dir: Found"
     else
-      echo "$dir: ---Missing---"
+      echo "$dir: ---Missing--- $state"
     fi
   done
-  # print a status message with the number of directories found
-  expected_directories=$(find $configs_root -type d | wc -l)
-  total_directories=$(find $zarr_root -maxdepth 1 -type d | wc -l)
+  expected_directories=$(find "$configs_root" -mindepth 1 -maxdepth 1 -type d | wc -l)
+  total_directories=$(sqlite3 "$manifest" "SELECT count(*) FROM jobs WHERE stage = 'hourly-zarr' AND state = 'done'")
   echo "Expected Directories: $expected_directories"
   echo "Total Directories: $total_directories"
   echo "Percent Complete: $(echo "scale=5; $total_directories / $expected_directories * 100" | bc)"
 
+elif [ "$1" == "-m" ]; then
+  # every stage of the manifest by job state, with the size of the recorded outputs
+  sqlite3 -header -column "$manifest" "
+    SELECT stage, state, count(*) AS jobs, round(sum(coalesce(bytes, 0)) / 1e9, 2) AS gb,
+           round(sum(coalesce(seconds, 0)) / 3600, 2) AS hours
+    FROM jobs GROUP BY stage, state ORDER BY stage, state"
+
 elif [ "$1" == "-f" ]; then
   for zarr in hourly daily monthly-timeseries monthly-timesteps yearly-timeseries yearly-timesteps maximums; do
     if [ -d "$final_root/$zarr.zarr" ]; then
@@ -57,6 +63,6 @@ elif [ "$1" == "-f" ]; then
     fi
   done
 else
-    echo "Invalid flag. Please use -v, -d, -z, -f"
+    echo "Invalid flag. Please use -v, -d, -z, -f, -m"
     exit 1
 fi
\ No newline at end of file
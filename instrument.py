@@ -0,0 +1,116 @@
+"""
+Per-job wall time, CPU time, peak memory and IO bytes, appended as one JSON line per job, and a summary per stage.
+
+    python instrument.py            # summary of every stage in the log
+    python instrument.py route fdc  # only these stages
+"""
+import functools
+import json
+import os
+import resource
+import sys
+import time
+import traceback
+
+import numpy as np
+
+log_file = '/home/ubuntu/jobs.jsonl'
+
+
+def io_bytes() -> tuple:
+    # bytes this process has read from and written to storage (linux only, zeros elsewhere)
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def write_record(record) -> None:
+    # one short line per job opened in append mode, so lines from concurrent workers do not interleave
+    with open(log_file, 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+
+def measure(stage, job, func, *args, units=None, memory_units=None):
+    """
+    Call func(*args) and log its wall and CPU seconds, the peak RSS of the process, IO bytes and whether it raised.
+    The peak RSS is the peak of the worker process so far, which is the job's own peak when workers run one task
+    each (maxtasksperchild=1) and an upper bound otherwise. Exceptions are logged with their traceback and re-raised.
+    """
+    start_wall = time.time()
+    start_cpu = time.process_time()
+    start_read, start_write = io_bytes()
+    status = 'ok'
+    error = None
+    try:
+        return func(*args)
+    except Exception as e:
+        status = 'error'
+        error = ''.join(traceback.format_exception(e))[-2000:]
+        raise
+    finally:
+        end_read, end_write = io_bytes()
+        write_record({
+            'stage': stage,
+            'job': job,
+            'pid': os.getpid(),
+            'start': start_wall,
+            'wall_s': round(time.time() - start_wall, 3),
+            'cpu_s': round(time.process_time() - start_cpu, 3),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'read_mb': round((end_read - start_read) / 2 ** 20, 1),
+            'write_mb': round((end_write - start_write) / 2 ** 20, 1),
+            'units': units,
+            'memory_units': memory_units,
+            'status': status,
+            'error': error,
+        })
+
+
+def instrumented(stage):
+    """
+    Decorator that logs every call of a job function with measure. The job is named by the first argument.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            return measure(stage, str(args[0])[:200] if args else '', func, *args)
+        return wrapper
+    return decorator
+
+
+def read_records(stage=None) -> list:
+    if not os.path.exists(log_file):
+        return []
+    with open(log_file) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return [r for r in records if stage is None or r['stage'] == stage]
+
+
+def summarize(stages=None) -> None:
+    """
+    Print, for each stage: job and error counts, total and p50/p95/max wall time, the average number of busy cores
+    (CPU / wall), the largest peak RSS and total GB read and written.
+    """
+    records = read_records()
+    stages = stages or sorted(set(r['stage'] for r in records))
+    print(f'{"stage":<24}{"jobs":>7}{"errors":>7}{"wall h":>9}{"p50 s":>9}{"p95 s":>9}{"max s":>9}'
+          f'{"cores":>7}{"peak GB":>9}{"read GB":>9}{"write GB":>9}')
+    for stage in stages:
+        rows = [r for r in records if r['stage'] == stage]
+        if not rows:
+            continue
+        wall = np.array([r['wall_s'] for r in rows])
+        cpu = np.array([r['cpu_s'] for r in rows])
+        print(
+            f'{stage:<24}{len(rows):>7}{sum(r["status"] == "error" for r in rows):>7}'
+            f'{wall.sum() / 3600:>9.2f}{np.percentile(wall, 50):>9.1f}{np.percentile(wall, 95):>9.1f}{wall.max():>9.1f}'
+            f'{cpu.sum() / max(wall.sum(), 1e-9):>7.2f}{max(r["peak_rss_mb"] for r in rows) / 1024:>9.2f}'
+            f'{sum(r["read_mb"] for r in rows) / 1024:>9.2f}{sum(r["write_mb"] for r in rows) / 1024:>9.2f}'
+        )
+
+
+if __name__ == '__main__':
+    summarize(sys.argv[1:])
@@ -0,0 +1,75 @@
+"""
+SQLite record of every job of every stage, so completion checks are one query instead of globs and marker files.
+"""
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+manifest_file = '/home/ubuntu/manifest.sqlite'
+
+
+def connect() -> sqlite3.Connection:
+    # WAL lets the pool workers record jobs while the main process reads
+    con = sqlite3.connect(manifest_file, timeout=60)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.execute(
+        'CREATE TABLE IF NOT EXISTS jobs ('
+        'stage TEXT, job TEXT, state TEXT, outputs TEXT, bytes INTEGER, checksum TEXT, seconds REAL, updated REAL, '
+        'PRIMARY KEY (stage, job))'
+    )
+    return con
+
+
+def file_checksum(path) -> str:
+    crc = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 24), b''):
+            crc = zlib.crc32(block, crc)
+    return f'{crc:08x}'
+
+
+def record(stage, job, state='done', outputs=(), seconds=None, checksum=False) -> None:
+    """
+    Record the state of a job with the total size of its output files, and a crc32 of them if checksum is True
+    (which reads every byte, so it is off by default). Directories such as zarr stores count as 0 bytes.
+    """
+    outputs = list(outputs)
+    files = [o for o in outputs if os.path.isfile(o)]
+    crc = ','.join(file_checksum(f) for f in files) if checksum else None
+    with connect() as con:
+        con.execute(
+            'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (stage, job, state, json.dumps(outputs), sum(os.path.getsize(f) for f in files), crc, seconds, time.time()),
+        )
+    con.close()
+
+
+def record_many(stage, jobs, state='done') -> None:
+    # jobs is an iterable of (job, [output paths]), e.g. to seed a stage from outputs that predate the manifest
+    rows = [(stage, job, state, json.dumps(list(outputs)), None, None, None, time.time()) for job, outputs in jobs]
+    with connect() as con:
+        con.executemany('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    con.close()
+
+
+def jobs_in_state(stage, state='done') -> set:
+    with connect() as con:
+        jobs = {row[0] for row in con.execute('SELECT job FROM jobs WHERE stage = ? AND state = ?', (stage, state))}
+    con.close()
+    return jobs
+
+
+def is_done(stage, job) -> bool:
+    with connect() as con:
+        row = con.execute('SELECT state FROM jobs WHERE stage = ? AND job = ?', (stage, job)).fetchone()
+    con.close()
+    return row is not None and row[0] == 'done'
+
+
+def stage_is_empty(stage) -> bool:
+    with connect() as con:
+        row = con.execute('SELECT 1 FROM jobs WHERE stage = ? LIMIT 1', (stage, )).fetchone()
+    con.close()
+    return row is None
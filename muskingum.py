@@ -0,0 +1,305 @@
+"""
+Matrix Muskingum routing that reads the same routing parameters, connectivity and state parquet files as river-route
+but takes catchment volumes as an iterable of in-memory blocks instead of volumes_*.nc files.
+"""
+import hashlib
+import os
+from glob import glob
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.linalg import factorized
+
+from scheduler import fork
+
+
+def read_network(params_file, connectivity_file):
+    """
+    Returns the river ids in routing order, the (downstream, upstream) adjacency matrix and the k and x parameters
+    """
+    params = pd.read_parquet(params_file, columns=['river_id', 'k', 'x'])
+    connectivity = pd.read_parquet(connectivity_file, columns=['river_id', 'downstream_river_id'])
+    river_ids = params['river_id'].values
+    downstream = connectivity.set_index('river_id')['downstream_river_id'].reindex(river_ids).values
+    downstream = pd.Index(river_ids).get_indexer(downstream)
+    upstream = np.flatnonzero(downstream >= 0)
+    adjacency = sparse.csc_matrix(
+        (np.ones(upstream.shape[0]), (downstream[upstream], upstream)),
+        shape=(river_ids.shape[0], river_ids.shape[0]),
+    )
+    return river_ids, adjacency, params['k'].values, params['x'].values
+
+
+def read_state(state_file, n_rivers):
+    if not state_file:
+        return np.zeros(n_rivers), np.zeros(n_rivers)
+    df = pd.read_parquet(state_file)
+    return df['Q'].values, df['R'].values
+
+
+def write_state(state_file, q, r) -> None:
+    pd.DataFrame({'Q': q, 'R': r}).to_parquet(state_file)
+
+
+def muskingum_lhs(adjacency, k, x, dt_routing):
+    dk = dt_routing / k
+    denominator = dk + 2 * (1 - x)
+    c1 = (dk - 2 * x) / denominator
+    c2 = (dk + 2 * x) / denominator
+    c3 = (2 * (1 - x) - dk) / denominator
+    lhs = sparse.identity(adjacency.shape[0], format='csc') - sparse.diags(c1) @ adjacency
+    return c1, c2, c3, lhs.tocsc()
+
+
+def muskingum_operators(adjacency, k, x, dt_routing):
+    c1, c2, c3, lhs = muskingum_lhs(adjacency, k, x, dt_routing)
+    return c1, c2, c3, factorized(lhs)
+
+
+def operators_file(params_file, connectivity_file, dt_routing) -> str:
+    # named by a hash of the contents of both parquet files, so edited parameters or connectivity are never reused
+    digest = hashlib.sha256()
+    for file in (params_file, connectivity_file):
+        with open(file, 'rb') as f:
+            digest.update(f.read())
+    digest.update(str(dt_routing).encode())
+    return os.path.join(os.path.dirname(params_file), f'routing_operators_{digest.hexdigest()[:16]}.npz')
+
+
+def read_operators(params_file, connectivity_file, dt_routing=3600):
+    """
+    Returns the network (see read_network) and the Muskingum operators (see muskingum_operators) of a vpu. The arrays
+    are saved to a routing_operators_{hash}.npz next to the parquet files the first time and loaded from it later.
+    The sparse LU factors cannot be saved, so the saved left hand side matrix is factorized again on load, which takes
+    a fraction of the time of rebuilding the network from the parquet files.
+    """
+    cache_file = operators_file(params_file, connectivity_file, dt_routing)
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as f:
+            n = f['river_ids'].shape[0]
+            adjacency = sparse.csc_matrix(
+                (np.ones(f['adjacency_indices'].shape[0]), f['adjacency_indices'], f['adjacency_indptr']), shape=(n, n)
+            )
+            lhs = sparse.csc_matrix((f['lhs_data'], f['lhs_indices'], f['lhs_indptr']), shape=(n, n))
+            network = (f['river_ids'], adjacency, f['k'], f['x'])
+            return network, (f['c1'], f['c2'], f['c3'], factorized(lhs))
+
+    network = read_network(params_file, connectivity_file)
+    river_ids, adjacency, k, x = network
+    c1, c2, c3, lhs = muskingum_lhs(adjacency, k, x, dt_routing)
+    for old_file in glob(os.path.join(os.path.dirname(cache_file), 'routing_operators_*.npz')):
+        # other hashes are stale, the longer names are copies being written by other processes
+        if old_file != cache_file and len(old_file) == len(cache_file):
+            os.remove(old_file)
+    # several decades of a vpu may build the same file at once, so each writes its own copy and renames it
+    temporary_file = f'{cache_file[:-4]}_{os.getpid()}.npz'
+    np.savez(
+        temporary_file,
+        river_ids=river_ids, k=k, x=x, c1=c1, c2=c2, c3=c3,
+        adjacency_indices=adjacency.indices, adjacency_indptr=adjacency.indptr,
+        lhs_data=lhs.data, lhs_indices=lhs.indices, lhs_indptr=lhs.indptr,
+    )
+    os.replace(temporary_file, cache_file)
+    return network, (c1, c2, c3, factorized(lhs))
+
+
+def outflow_buffer(buffer, n_times, n_rivers, scratch_file=None):
+    """
+    A float32 (time, river_id) array for the outflows of one block, reused from buffer if it has enough rows. With a
+    scratch_file the array is memory mapped to that file so its pages can be written back instead of held in RAM.
+    """
+    if buffer is not None and buffer.shape[0] >= n_times:
+        return buffer
+    if scratch_file is None:
+        return np.empty((n_times, n_rivers), dtype=np.float32)
+    return np.memmap(scratch_file, dtype=np.float32, mode='w+', shape=(n_times, n_rivers))
+
+
+def block_runoffs(volumes, river_ids, dt_routing):
+    # lateral inflow in m3 s-1 as float32 in routing order, and the routing steps per runoff timestep
+    dt_runoff = (volumes.index[1] - volumes.index[0]).total_seconds() if volumes.shape[0] > 1 else dt_routing
+    # divided into a new array: to_numpy can return a read-only view of the caller's DataFrame
+    if not np.array_equal(volumes.columns.values, river_ids):
+        volumes = volumes[river_ids]
+    return volumes.to_numpy(dtype=np.float32) / np.float32(dt_runoff), int(dt_runoff // dt_routing)
+
+
+def route_blocks(network, blocks, q, r, dt_routing=3600, operators=None, scratch_file=None):
+    """
+    Route an iterable of catchment volume DataFrames (time x river_id, m3 per runoff timestep). Yields the outflow
+    DataFrame (average m3/s over each runoff timestep) and the state arrays after each block. The operators are built
+    from the network unless given (see read_operators).
+
+    The outflows of every block are written into the same float32 buffer (see outflow_buffer), so memory holds one
+    block at a time and each yielded DataFrame is only valid until the next block is requested.
+    """
+    river_ids, adjacency, k, x = network
+    c1, c2, c3, solve = operators or muskingum_operators(adjacency, k, x, dt_routing)
+    buffer = None
+    for volumes in blocks:
+        runoffs, n_steps = block_runoffs(volumes, river_ids, dt_routing)
+        buffer = outflow_buffer(buffer, runoffs.shape[0], river_ids.shape[0], scratch_file)
+        outflows = buffer[:runoffs.shape[0]]
+        outflows[:] = 0
+        for t in range(runoffs.shape[0]):
+            r_t = runoffs[t]
+            for _ in range(n_steps):
+                q = solve(c1 * r_t + c2 * (adjacency @ q + r) + c3 * q)
+                r = r_t
+                outflows[t] += q
+        outflows /= n_steps
+        yield pd.DataFrame(outflows, index=volumes.index, columns=river_ids, copy=False), q, r
+
+
+split_pieces = []  # operators of each piece of the network being routed by route_blocks_split
+
+
+def split_network(network, n_pieces):
+    """
+    Partition the rivers into pieces that can be routed on separate workers. Walking from the headwaters down, a river
+    whose not yet assigned upstream area holds at least 1/n_pieces of the rivers becomes the outlet of a piece, so each
+    piece only receives inflow from the outlets of the pieces directly upstream of it. Pieces are grouped into waves
+    by their distance from the headwater pieces, and the pieces of each wave are packed (largest first) into at most
+    n_pieces groups. Returns a list of waves, each a list of sorted river index arrays.
+    """
+    river_ids, adjacency, _, _ = network
+    n = river_ids.shape[0]
+    target = max(1, n // n_pieces)
+    edges = adjacency.tocoo()
+    downstream = np.full(n, -1)
+    downstream[edges.col] = edges.row
+
+    # topological order from the headwaters to the outlets
+    n_upstream = np.bincount(edges.row, minlength=n)
+    order = list(np.flatnonzero(n_upstream == 0))
+    for i in order:
+        d = downstream[i]
+        if d >= 0:
+            n_upstream[d] -= 1
+            if n_upstream[d] == 0:
+                order.append(d)
+
+    size = np.zeros(n, dtype=np.int64)
+    is_outlet = np.zeros(n, dtype=bool)
+    for i in order:
+        size[i] += 1
+        if size[i] >= target or downstream[i] < 0:
+            is_outlet[i] = True
+        else:
+            size[downstream[i]] += size[i]
+    piece = np.empty(n, dtype=np.int64)
+    for i in reversed(order):
+        piece[i] = i if is_outlet[i] else piece[downstream[i]]
+
+    # a piece is one wave after the latest piece that drains into it
+    level = {}
+    upstream_pieces = {}
+    cut = np.flatnonzero((downstream >= 0) & (piece != piece[np.maximum(downstream, 0)]))
+    for u in cut:
+        upstream_pieces.setdefault(piece[downstream[u]], []).append(piece[u])
+    for i in order:
+        if is_outlet[i]:
+            level[i] = 1 + max((level[u] for u in upstream_pieces.get(i, [])), default=-1)
+
+    by_piece = np.argsort(piece, kind='stable')
+    labels, starts = np.unique(piece[by_piece], return_index=True)
+    members = dict(zip(labels, np.split(by_piece, starts[1:])))
+    waves = []
+    for wave in range(max(level.values()) + 1):
+        outlets = sorted((o for o in level if level[o] == wave), key=lambda o: -members[o].shape[0])
+        groups = [[] for _ in range(min(n_pieces, len(outlets)))]
+        group_sizes = np.zeros(len(groups), dtype=np.int64)
+        for o in outlets:
+            g = int(np.argmin(group_sizes))
+            groups[g].append(members[o])
+            group_sizes[g] += members[o].shape[0]
+        waves.append([np.sort(np.concatenate(g)) for g in groups])
+    return waves
+
+
+def piece_operators(network, rivers, exported, dt_routing):
+    """
+    Operators of one piece: its own Muskingum operators, the matrix of inflows from river outlets of other pieces
+    (the boundary) and the local indices of its rivers whose outflow other pieces need.
+    """
+    _, adjacency, k, x = network
+    rows = adjacency.tocsr()[rivers]
+    c1, c2, c3, solve = muskingum_operators(rows[:, rivers].tocsc(), k[rivers], x[rivers], dt_routing)
+    boundary = np.setdiff1d(np.unique(rows.indices), rivers)
+    local_exports = np.flatnonzero(np.isin(rivers, exported))
+    return {
+        'inner': rows[:, rivers].tocsr(),
+        'inflows': rows[:, boundary].tocsr(),
+        'boundary': np.searchsorted(exported, boundary),
+        'exports': np.searchsorted(exported, rivers[local_exports]),
+        'local_exports': local_exports,
+        'c1': c1, 'c2': c2, 'c3': c3, 'solve': solve,
+    }
+
+
+def route_piece(args):
+    """
+    Route one piece through a block given the outflow of its boundary rivers at every routing step. Returns the
+    outflows, the outflow of its exported rivers at every routing step and its final state.
+    """
+    index, runoffs, boundary_q, boundary_q0, q, r, n_steps = args
+    ops = split_pieces[index]
+    inner, inflows, c1, c2, c3, solve = (ops[k] for k in ('inner', 'inflows', 'c1', 'c2', 'c3', 'solve'))
+    outflows = np.zeros(runoffs.shape, dtype=np.float32)
+    exports = np.empty((runoffs.shape[0] * n_steps, ops['local_exports'].shape[0]))
+    inflow = inflows @ boundary_q0
+    for t in range(runoffs.shape[0]):
+        r_t = runoffs[t]
+        for s in range(n_steps):
+            new_inflow = inflows @ boundary_q[t * n_steps + s]
+            q = solve(c1 * (r_t + new_inflow) + c2 * (inner @ q + r + inflow) + c3 * q)
+            inflow = new_inflow
+            r = r_t
+            outflows[t] += q
+            exports[t * n_steps + s] = q[ops['local_exports']]
+    return index, outflows / n_steps, exports, q, r
+
+
+def route_blocks_split(network, blocks, q, r, dt_routing=3600, n_workers=8, scratch_file=None):
+    """
+    Same results as route_blocks, but the network is split into pieces (see split_network) that are routed on
+    n_workers processes. For each block, the pieces of a wave run at the same time and only the outflows of the rivers
+    that drain into another piece are passed on to the next wave. Outflows share one buffer like route_blocks.
+    """
+    global split_pieces
+    river_ids, adjacency, _, _ = network
+    q, r = q.copy(), r.copy()
+    waves = split_network(network, n_workers)
+    pieces = [rivers for wave in waves for rivers in wave]
+    piece_of = np.empty(river_ids.shape[0], dtype=np.int64)
+    for i, rivers in enumerate(pieces):
+        piece_of[rivers] = i
+    edges = adjacency.tocoo()
+    exported = np.unique(edges.col[piece_of[edges.col] != piece_of[edges.row]])
+    split_pieces = [piece_operators(network, rivers, exported, dt_routing) for rivers in pieces]
+    wave_pieces = np.cumsum([0, ] + [len(wave) for wave in waves])
+    print(f'split {river_ids.shape[0]} rivers into {len(pieces)} pieces in {len(waves)} waves')
+
+    buffer = None
+    with fork.Pool(n_workers) as p:
+        for volumes in blocks:
+            runoffs, n_steps = block_runoffs(volumes, river_ids, dt_routing)
+            buffer = outflow_buffer(buffer, runoffs.shape[0], river_ids.shape[0], scratch_file)
+            outflows = buffer[:runoffs.shape[0]]
+            exported_q = np.empty((runoffs.shape[0] * n_steps, exported.shape[0]))
+            exported_q0 = q[exported]
+            for first, last in zip(wave_pieces[:-1], wave_pieces[1:]):
+                jobs = []
+                for i in range(first, last):
+                    rivers, ops = pieces[i], split_pieces[i]
+                    jobs.append((
+                        i, runoffs[:, rivers], exported_q[:, ops['boundary']], exported_q0[ops['boundary']],
+                        q[rivers], r[rivers], n_steps,
+                    ))
+                for i, piece_outflows, exports, piece_q, piece_r in p.imap_unordered(route_piece, jobs):
+                    outflows[:, pieces[i]] = piece_outflows
+                    exported_q[:, split_pieces[i]['exports']] = exports
+                    q[pieces[i]] = piece_q
+                    r[pieces[i]] = piece_r
+            yield pd.DataFrame(outflows, index=volumes.index, columns=river_ids, copy=False), q, r
@@ -0,0 +1,127 @@
+"""
+Bounded memory conversion between the time series (time: -1) and timesteps (time: 1) chunk layouts of the final zarrs.
+"""
+import math
+import shutil
+
+import numpy as np
+import xarray as xr
+
+from scheduler import fork
+from zarr_stores import create_store, open_variable, write_shape
+
+
+def resolve_chunks(shape, chunks):
+    return tuple(s if c == -1 else min(c, s) for s, c in zip(shape, chunks))
+
+
+def block_shape(shape, read_chunks, write_chunks):
+    # the smallest block that is made of whole chunks of both the store read and the store written
+    return tuple(min(s, math.lcm(r, w)) for s, r, w in zip(shape, read_chunks, write_chunks))
+
+
+def plan_rechunk(shape, source_chunks, target_chunks, itemsize, memory_budget):
+    """
+    Returns None if blocks of whole source and target chunks fit in memory_budget bytes and can be copied directly.
+    Otherwise returns the chunks of an intermediate store: they start at the smaller of the source and target chunks
+    on each axis and are doubled while the blocks of both copies (source to intermediate, intermediate to target)
+    still fit in the budget, so the intermediate store has as few chunks as the budget allows.
+    """
+    if np.prod(block_shape(shape, source_chunks, target_chunks)) * itemsize <= memory_budget:
+        return None
+    intermediate = [min(a, b) for a, b in zip(source_chunks, target_chunks)]
+    grown = True
+    while grown:
+        grown = False
+        for axis in range(len(shape)):
+            trial = list(intermediate)
+            trial[axis] = min(shape[axis], intermediate[axis] * 2)
+            if trial[axis] == intermediate[axis]:
+                continue
+            largest_block = max(
+                np.prod(block_shape(shape, source_chunks, trial)),
+                np.prod(block_shape(shape, trial, target_chunks)),
+            )
+            if largest_block * itemsize <= memory_budget:
+                intermediate = trial
+                grown = True
+    return tuple(intermediate)
+
+
+def iter_blocks(shape, block):
+    for t in range(0, shape[0], block[0]):
+        for r in range(0, shape[1], block[1]):
+            yield slice(t, min(t + block[0], shape[0])), slice(r, min(r + block[1], shape[1]))
+
+
+def copy_block(args):
+    source_path, target_path, var_name, block = args
+    open_variable(target_path, var_name)[block] = open_variable(source_path, var_name, mode='r')[block]
+
+
+def rechunk(source_path, target_path, target_chunks, memory_budget, n_workers, intermediate_path, var_name='Q',
+            target_shards=None) -> None:
+    """
+    Copy a (time, river_id) store into a new store with different chunks, optionally grouped into target_shards (see
+    create_store). Each worker holds at most memory_budget bytes. When no block of whole source chunks and whole target
+    chunks or shards fits in the budget, the transpose goes through an intermediate store that is deleted afterward
+    (see plan_rechunk).
+    """
+    with xr.open_zarr(source_path) as ds:
+        dims = ds[var_name].dims
+        coords = {d: ds[d].values for d in dims}
+        attrs = ds.attrs
+        var_attrs = ds[var_name].attrs
+    source = open_variable(source_path, var_name, mode='r')
+    target_chunks = resolve_chunks(source.shape, [target_chunks[d] for d in dims])
+    create_store(
+        target_path, dims, coords, dict(zip(dims, target_chunks)), var_name, str(source.dtype), attrs, var_attrs,
+        target_shards,
+    )
+    # workers write whole shards of a sharded target
+    target_chunks = write_shape(open_variable(target_path, var_name, mode='r'))
+    plan = plan_rechunk(source.shape, source.chunks, target_chunks, source.dtype.itemsize, memory_budget)
+
+    stages = []
+    if plan is None:
+        stages.append((source_path, target_path, block_shape(source.shape, source.chunks, target_chunks)))
+    else:
+        print(f'rechunking through {intermediate_path} with chunks {plan}')
+        create_store(intermediate_path, dims, coords, dict(zip(dims, plan)), var_name, str(source.dtype))
+        stages.append((source_path, intermediate_path, block_shape(source.shape, source.chunks, plan)))
+        stages.append((intermediate_path, target_path, block_shape(source.shape, plan, target_chunks)))
+
+    for read_path, write_path, block in stages:
+        jobs = [(read_path, write_path, var_name, b) for b in iter_blocks(source.shape, block)]
+        with fork.Pool(n_workers) as p:
+            list(p.imap_unordered(copy_block, jobs))
+    if plan is not None:
+        shutil.rmtree(intermediate_path)
+
+
+def write_layout_block(args):
+    compute_block, paths, var_name, r0, r1, time_slice = args
+    values = compute_block(r0, r1)
+    for path in paths:
+        open_variable(path, var_name)[time_slice, r0:r1] = values
+    return r0, r1
+
+
+def write_layouts(compute_block, n_rivers, paths, n_workers, var_name='Q', time_slice=slice(None),
+                  rivers_per_block=1) -> None:
+    """
+    Fill several already created (time, river_id) stores that differ only in their chunks from the same blocks.
+    compute_block(r0, r1) returns the values of rivers r0:r1 for the rows in time_slice (all times by default). Blocks
+    span whole river_id chunks (or shards) of every store so each block is computed once, held in memory once, and
+    written to every layout with no second pass. Blocks are widened to at least rivers_per_block rivers.
+    """
+    widths = [write_shape(open_variable(path, var_name, mode='r'))[1] for path in paths]
+    width = math.lcm(*widths)
+    width = min(n_rivers, max(width, rivers_per_block // width * width))
+    jobs = [
+        (compute_block, paths, var_name, r0, min(r0 + width, n_rivers), time_slice)
+        for r0 in range(0, n_rivers, width)
+    ]
+    with fork.Pool(n_workers) as p:
+        for r0, r1 in p.imap_unordered(write_layout_block, jobs):
+            print(f'Finished rivers {r0} to {r1}')
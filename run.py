@@ -0,0 +1,182 @@
+"""
+Runs the volumes, routing and hourly zarr conversion of every vpu as one dependency graph on a local process pool, so
+each task starts as soon as its own inputs exist instead of when the whole previous stage has finished:
+
+    volumes {vpu} {decade} -> route {vpu} {decade} -> route {vpu} {decade + 10} ... -> convert {vpu} -> assemble
+
+Completion is read from the job manifest, so a restarted run only schedules what is left.
+"""
+import inspect
+import os
+import runpy
+import threading
+from glob import glob
+
+from natsort import natsorted
+
+from instrument import measure
+from manifest import is_done, jobs_in_state
+from scheduler import fork, parquet_rows
+
+configs_root = '/home/ubuntu/routing_configs'
+runoffs_root = '/mnt/era5'
+decades = list(range(1940, 2030, 10))
+n_workers = 92
+stage_limits = {'convert': 6}  # most tasks of a stage running at once, convert holds ~15 GB per write block
+
+# the stage scripts are loaded without running their main blocks and inherited by the forked workers (see
+# scheduler.fork), so tasks are sent to them by name rather than by pickling functions from these namespaces.
+volumes_stage = runpy.run_path('1 volumes.py')
+route_stage = runpy.run_path('2 route.py')
+hourly_stage = runpy.run_path('3 hourly.py')
+runoff_files = natsorted(glob(os.path.join(runoffs_root, 'year=*/*.nc')))
+
+
+def configure_stages() -> None:
+    """
+    Point the conversion at what routing writes: the hourly product is added to the route stage's outflow_products,
+    whose default is only the maxima, and convert and assemble read the route stage's discharge_root and zarr_root.
+    The globals the stage functions read are changed, not the copies runpy returns.
+    """
+    route_globals = inspect.unwrap(route_stage['route']).__globals__
+    hourly_globals = inspect.unwrap(hourly_stage['convert']).__globals__
+    if 'hourly' not in route_globals['outflow_products']:
+        route_globals['outflow_products'] = route_globals['outflow_products'] + ['hourly', ]
+    hourly_globals['discharge_root'] = route_globals['discharge_root']
+    hourly_globals['zarr_root'] = route_globals['zarr_root']
+
+
+def runoff_month(runoff_file) -> str:
+    return os.path.basename(runoff_file).split('_')[1][:6]
+
+
+def decade_runoff_files(decade) -> list:
+    return [f for f in runoff_files if runoff_month(f)[:3] == str(decade)[:3]]
+
+
+def run_volumes(vpu, decade) -> None:
+    volumes_stage['compute_volumes']([os.path.join(configs_root, vpu), decade_runoff_files(decade)])
+
+
+def run_route(vpu, decade) -> None:
+    configs = os.path.join(configs_root, vpu)
+    route_stage['prepare_outputs'](configs)
+    route_stage['route_decade'](
+        vpu, f'{configs}/routing_parameters_faster.parquet', f'{configs}/connectivity.parquet', decade
+    )
+    route_stage['flush_annual_max'](vpu)
+    route_stage['mark_zarr_complete'](vpu)
+
+
+def run_convert(vpu) -> None:
+    if not is_done('hourly-zarr', vpu):
+        hourly_stage['convert'](vpu)
+
+
+task_functions = {'volumes': run_volumes, 'route': run_route, 'convert': run_convert}
+instrumented_tasks = {'convert'}  # the stage function is already logged by instrument.instrumented
+
+
+def run_task(task):
+    if task[0] in instrumented_tasks:
+        task_functions[task[0]](*task[1:])
+    else:
+        measure(task[0], ' '.join(str(t) for t in task[1:]), task_functions[task[0]], *task[1:])
+    return task
+
+
+def build_graph(vpus) -> dict:
+    # task -> tasks it depends on
+    graph = {}
+    for vpu in vpus:
+        for i, decade in enumerate(decades):
+            graph[('volumes', vpu, decade)] = []
+            previous = [('route', vpu, decades[i - 1]), ] if i else []
+            graph[('route', vpu, decade)] = [('volumes', vpu, decade), ] + previous
+        graph[('convert', vpu)] = [('route', vpu, decade) for decade in decades]
+    return graph
+
+
+def completed_tasks(graph) -> set:
+    volumes_done = jobs_in_state('volumes')
+    route_done = jobs_in_state('route')
+    convert_done = jobs_in_state('hourly-zarr')
+    done = set()
+    for task in graph:
+        kind, vpu = task[:2]
+        if kind == 'volumes':
+            months = [runoff_month(f) for f in decade_runoff_files(task[2])]
+            complete = all(f'{vpu}/{m}' in volumes_done for m in months)
+        elif kind == 'route':
+            complete = f'{vpu}/{task[2]}' in route_done
+        else:
+            complete = vpu in convert_done
+        if complete:
+            done.add(task)
+    return done
+
+
+def run_graph(graph, priority) -> set:
+    """
+    Run every task whose dependencies are complete, highest priority first with at most stage_limits of a stage at
+    once, and start the tasks that depend on a task as soon as the manifest shows it completed. Returns the tasks that
+    failed or could not run.
+    """
+    done = completed_tasks(graph)
+    waiting = set(graph) - done
+    running = set()
+    failed = set()
+    finished = threading.Condition()
+
+    def on_finished(task):
+        # the stage functions print and swallow their own errors, so success is read back from the manifest
+        complete = task in completed_tasks({task: []})
+        with finished:
+            running.discard(task)
+            (done if complete else failed).add(task)
+            finished.notify()
+
+    def on_error(task, e):
+        print(f'{task} failed: {e}')
+        with finished:
+            running.discard(task)
+            failed.add(task)
+            finished.notify()
+
+    print(f'{len(done)} of {len(graph)} tasks already complete')
+    with fork.Pool(n_workers) as p:
+        with finished:
+            while True:
+                ready = [t for t in waiting if all(d in done for d in graph[t])]
+                for task in sorted(ready, key=priority):
+                    if len(running) >= n_workers:
+                        break
+                    if sum(t[0] == task[0] for t in running) >= stage_limits.get(task[0], n_workers):
+                        continue
+                    waiting.discard(task)
+                    running.add(task)
+                    p.apply_async(
+                        run_task, args=(task,),
+                        callback=on_finished, error_callback=lambda e, task=task: on_error(task, e),
+                    )
+                if not running:
+                    break
+                finished.wait()
+    return failed | waiting
+
+
+if __name__ == '__main__':
+    configure_stages()
+    configs_dirs = [d for d in natsorted(glob(os.path.join(configs_root, '*'))) if os.path.isdir(d)]
+    n_rivers = {os.path.basename(c): parquet_rows(c) for c in configs_dirs}
+    graph = build_graph(list(n_rivers))
+
+    # routing is the chain that takes longest, so ready routing starts first, then the largest vpus
+    stage_order = {'route': 0, 'volumes': 1, 'convert': 2}
+    not_run = run_graph(graph, priority=lambda t: (stage_order[t[0]], -n_rivers[t[1]], t[2:]))
+    if not_run:
+        print(f'{len(not_run)} tasks failed or were blocked by a failure: {natsorted(not_run)[:20]}')
+    else:
+        # the assembly starts its own pool, so it runs here after every vpu is converted
+        hourly_stage['assemble']()
+    print('completed')
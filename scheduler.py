@@ -0,0 +1,101 @@
+"""
+Runs pool jobs largest first under a memory budget, with per-job cost estimates from parquet metadata and past runs.
+"""
+import os
+import threading
+from multiprocessing import get_context
+
+import numpy as np
+import pyarrow.parquet as pq
+
+from instrument import measure, read_records
+
+# the workers read data prepared by the main process (e.g. stacked_weights, the stages loaded by run.py) from the module
+# globals they inherit, which only forked workers have. fork is not the default on macos, or on linux from python 3.14,
+# so every pool, process and queue is started from this context.
+fork = get_context('fork')
+
+
+def parquet_rows(configs) -> int:
+    # the row count from the parquet footer, without reading the columns
+    return pq.ParquetFile(os.path.join(configs, 'routing_parameters.parquet')).metadata.num_rows
+
+
+def cost_model(stage, default_seconds_per_unit, default_mb_per_unit, base_mb=500):
+    """
+    Returns a function of a job's (units, memory_units) giving its estimated (seconds, peak MB). units is the work of
+    the job (e.g. rivers x months) and memory_units what it holds in memory at once (e.g. rivers), since a job that
+    routes or reads one month at a time does not need more memory for a longer record. The time per unit is the median
+    of past runs of the stage. The memory is a line fitted to past runs, base_mb plus mb_per_unit per memory unit, with
+    the base raised until no past run is above it, so memory is overestimated rather than under. Stages without
+    history use the defaults.
+    """
+    rows = [r for r in read_records(stage) if r['status'] == 'ok' and r['units']]
+    seconds_per_unit = default_seconds_per_unit
+    mb_per_unit = default_mb_per_unit
+    if rows:
+        units = np.array([r['units'] for r in rows], dtype=float)
+        seconds_per_unit = float(np.median(np.array([r['wall_s'] for r in rows]) / units))
+    rows = [r for r in rows if r.get('memory_units')]
+    if rows:
+        memory_units = np.array([r['memory_units'] for r in rows], dtype=float)
+        peak_mb = np.array([r['peak_rss_mb'] for r in rows], dtype=float)
+        if np.unique(memory_units).shape[0] > 1:
+            mb_per_unit = max(float(np.polyfit(memory_units, peak_mb, 1)[0]), 0)
+        base_mb = float(np.max(peak_mb - memory_units * mb_per_unit))
+    return lambda units, memory_units: (units * seconds_per_unit, base_mb + memory_units * mb_per_unit)
+
+
+def timed_job(args):
+    func, job, stage, name, units, memory_units = args
+    return measure(stage, name, func, job, units=units, memory_units=memory_units)
+
+
+def run_jobs(func, jobs, stage, names, units, memory_units, cost, n_workers, ram_budget_mb,
+             maxtasksperchild=1) -> None:
+    """
+    Call func(job) for every job on a pool of n_workers. Jobs are started longest estimated time first (LPT), but a
+    job is held back while the estimated peak memory of the running jobs plus its own would exceed ram_budget_mb, in
+    which case the next smaller job that fits is started instead. A job larger than the whole budget runs alone.
+    Workers are replaced after maxtasksperchild jobs so memory freed by finished jobs returns to the system, and each
+    job is logged by instrument.measure, which the cost model of later runs reads.
+    """
+    estimates = [cost(u, m) for u, m in zip(units, memory_units)]
+    order = sorted(range(len(jobs)), key=lambda i: -estimates[i][0])
+    total_seconds = sum(e[0] for e in estimates)
+    print(f'{stage}: {len(jobs)} jobs, estimated {total_seconds / 3600 / n_workers:.1f} hours on {n_workers} workers')
+
+    finished = threading.Condition()
+    running = {}  # job index -> estimated peak MB
+
+    def release(i):
+        with finished:
+            running.pop(i)
+            finished.notify()
+
+    def on_error(i, e):
+        print(f'{stage} job {names[i]} failed: {e}')
+        release(i)
+
+    with fork.Pool(n_workers, maxtasksperchild=maxtasksperchild) as p:
+        while order:
+            with finished:
+                free_mb = ram_budget_mb - sum(running.values())
+                fits = [i for i in order if estimates[i][1] <= free_mb] if len(running) < n_workers else []
+                if not fits and not running:
+                    fits = order[:1]
+                if not fits:
+                    finished.wait()
+                    continue
+                i = fits[0]
+                order.remove(i)
+                running[i] = estimates[i][1]
+            p.apply_async(
+                timed_job,
+                args=((func, jobs[i], stage, names[i], units[i], memory_units[i]),),
+                callback=lambda _, i=i: release(i),
+                error_callback=lambda e, i=i: on_error(i, e),
+            )
+        with finished:
+            while running:
+                finished.wait()
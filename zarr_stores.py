@@ -0,0 +1,349 @@
+"""
+Helpers for zarr stores that are allocated once and then filled piece by piece instead of written by one to_zarr call.
+
+    python zarr_stores.py /mnt/zarr/final/hourly.zarr Q  # choose the codec of Q from trial_codecs on sample chunks
+"""
+import json
+import os
+import shutil
+import sys
+import time
+
+import dask
+import dask.array as da
+import numcodecs
+import numcodecs.zarr3
+import numpy as np
+import xarray as xr
+import zarr
+
+from scheduler import fork
+
+# encoding of the variables of the stores created here, by variable name. keepbits: mantissa bits kept by bit rounding
+# before compression (float32 has 23), which bounds the relative error of every value by 2 ** -(keepbits + 1), or None
+# to store the values exactly. codec: (cname, clevel) of the Blosc compressor, see codec_trial.
+encodings_file = '/home/ubuntu/zarr_encodings.json'  # codecs chosen by codec_trial, by variable name
+default_encoding = {'keepbits': None, 'codec': ('zstd', 5)}
+variable_encodings = {
+    'Q': {'keepbits': None},  # e.g. 12: discharge within 0.013%, well inside the uncertainty of the simulation
+}
+trial_codecs = [('lz4', 5), ('lz4hc', 5), ('zstd', 1), ('zstd', 3), ('zstd', 5), ('zstd', 9), ('zlib', 5)]
+discharge_attrs = {
+    'long_name': 'Discharge at catchment outlet',
+    'standard_name': 'discharge',
+    'units': 'm3 s-1',
+}
+
+
+def trial_encodings() -> dict:
+    if not os.path.exists(encodings_file):
+        return {}
+    with open(encodings_file) as f:
+        return json.load(f)
+
+
+def save_codec(var_name, codec) -> None:
+    encodings = trial_encodings()
+    encodings.setdefault(var_name, {})['codec'] = list(codec)
+    with open(encodings_file, 'w') as f:
+        json.dump(encodings, f, indent=2)
+
+
+def encoding_policy(var_name) -> dict:
+    # the codec chosen by codec_trial applies unless variable_encodings sets one
+    return {**default_encoding, **trial_encodings().get(var_name, {}), **variable_encodings.get(var_name, {})}
+
+
+def variable_encoding(var_name, dtype, zarr_format=2) -> dict:
+    """
+    The compressor and filters of var_name in its encoding policy as to_zarr encoding for a zarr_format store. Bit
+    rounding only applies to floating point variables.
+    """
+    policy = encoding_policy(var_name)
+    cname, clevel = policy['codec']
+    keepbits = policy['keepbits'] if np.dtype(dtype).kind == 'f' else None
+    if zarr_format == 2:
+        return {
+            'compressor': numcodecs.Blosc(cname=cname, clevel=clevel, shuffle=numcodecs.Blosc.AUTOSHUFFLE),
+            'filters': None if keepbits is None else [numcodecs.BitRound(keepbits), ],
+        }
+    return {
+        'compressors': (zarr.codecs.BloscCodec(cname=cname, clevel=clevel, shuffle='shuffle'), ),
+        'filters': () if keepbits is None else (numcodecs.zarr3.BitRound(keepbits=keepbits), ),
+    }
+
+
+def create_store(path, dims, coords, chunks, var_name='Q', dtype='float32', attrs=None, var_attrs=None,
+                 shards=None, growing_dims=()) -> None:
+    """
+    Write the metadata and coordinates of a store without writing any chunks of var_name. Chunks that are never
+    written read back as the fill value (nan). A chunk size of -1 means the full length of that dimension. The
+    variable is compressed and rounded by its encoding policy (see variable_encodings).
+
+    With shards (a size per dimension like chunks) the store is zarr v3 and the chunks are grouped into one file per
+    shard, so a store of small chunks is a few large files. Shards are rounded up to whole chunks. Concurrent writers
+    must then write whole shards rather than whole chunks (see write_shape).
+
+    Chunks longer than a dimension are shortened to its length, except along growing_dims, the dimensions the store
+    will be extended along (see extend_time), so the rows added later fill whole chunks in order.
+    """
+    create_variables_store(path, {var_name: (dims, dtype, var_attrs)}, coords, chunks, attrs, shards, growing_dims)
+
+
+def create_variables_store(path, variables, coords, chunks, attrs=None, shards=None, growing_dims=()) -> None:
+    """
+    Like create_store for several variables with different dims. variables maps each name to (dims, dtype, attrs) and
+    chunks (and shards) give the size of every dimension used by any of them.
+    """
+    data_vars = {}
+    encoding = {}
+    for var_name, (dims, dtype, var_attrs) in variables.items():
+        shape = tuple(len(coords[d]) for d in dims)
+        var_chunks = tuple(
+            s if chunks[d] == -1 else chunks[d] if d in growing_dims else min(chunks[d], s) for d, s in zip(dims, shape)
+        )
+        if shards is None:
+            data_vars[var_name] = (dims, da.empty(shape, chunks=var_chunks, dtype=dtype), var_attrs or {})
+            encoding[var_name] = {**variable_encoding(var_name, dtype), 'chunks': var_chunks}
+            continue
+        var_shards = tuple(
+            -(-(s if shards[d] == -1 else shards[d] if d in growing_dims else min(shards[d], s)) // c) * c
+            for d, s, c in zip(dims, shape, var_chunks)
+        )
+        data_vars[var_name] = (dims, da.empty(shape, chunks=var_shards, dtype=dtype), var_attrs or {})
+        encoding[var_name] = {**variable_encoding(var_name, dtype, 3), 'chunks': var_chunks, 'shards': var_shards}
+    (
+        xr
+        .Dataset(data_vars, coords=coords, attrs=attrs or {})
+        .to_zarr(path, mode='w', zarr_format=2 if shards is None else 3, compute=False, consolidated=True,
+                 encoding=encoding)
+    )
+
+
+def open_variable(path, var_name='Q', mode='r+') -> zarr.Array:
+    # the zarr format (2, or 3 for sharded stores) is read from the store
+    return zarr.open_group(path, mode=mode)[var_name]
+
+
+def write_shape(array) -> tuple:
+    # the smallest block that can be written without rewriting part of a neighboring block: a shard or a chunk
+    return array.shards or array.chunks
+
+
+def extend_time(path, new_times, var_names=('Q', )) -> int:
+    """
+    Append new_times to the time coordinate of a store and grow var_names along time so the new rows can be filled
+    with region writes. Existing chunks are not rewritten. Returns the index of the first new row.
+    """
+    group = zarr.open_group(path, mode='r+')
+    time = group['time']
+    start = time.shape[0]
+    values, _, _ = xr.coding.times.encode_cf_datetime(
+        new_times, time.attrs['units'], time.attrs.get('calendar', 'proleptic_gregorian'), dtype=time.dtype
+    )
+    time.resize((start + len(new_times), ))
+    time[start:] = values
+    for var_name in var_names:
+        array = group[var_name]
+        array.resize((start + len(new_times), *array.shape[1:]))
+    zarr.consolidate_metadata(path)
+    return start
+
+
+def vpu_river_ids(args):
+    open_vpu, vpu = args
+    with open_vpu(vpu) as ds:
+        return ds['river_id'].values
+
+
+def read_vpu_layout(open_vpu, vpus, n_workers, var_name='Q'):
+    """
+    Returns each vpu's river ids, the river_id offset of each vpu when concatenated in the given order (plus the total
+    as the last entry), and the time coordinate and variable attributes of the first vpu.
+    """
+    with fork.Pool(n_workers) as p:
+        river_ids = p.map(vpu_river_ids, [(open_vpu, vpu) for vpu in vpus])
+    offsets = np.cumsum([0, ] + [r.shape[0] for r in river_ids])
+    with open_vpu(vpus[0]) as ds:
+        times = ds['time'].values
+        var_attrs = ds[var_name].attrs
+    return river_ids, offsets, times, var_attrs
+
+
+def chunk_aligned_bounds(start, end, chunk):
+    """
+    Split [start, end) into a partial leading chunk [start, head_end), whole chunks [head_end, tail_start) and a
+    partial trailing chunk [tail_start, end)
+    """
+    head_end = min(end, -(-start // chunk) * chunk)
+    tail_start = max(head_end, end // chunk * chunk)
+    return head_end, tail_start
+
+
+def chunk_copy_plan(vpu_path, path, var_name, offset):
+    """
+    Returns (global index of the vpu store's first river_id chunk, number of padding rivers at the start of the vpu
+    store) if the vpu store's compressed chunks can be copied into the global store unchanged, otherwise None. That
+    requires identical array metadata apart from the river_id length and chunk boundaries that line up after the
+    vpu is placed at its offset. The padding is stored in the 'river_id_lead' attribute by the writer of the vpu store.
+    Only zarr v2 chunk files are copied; a sharded global store is always written by decoding the vpu.
+    """
+    src = open_variable(vpu_path, var_name, mode='r')
+    dst = open_variable(path, var_name, mode='r')
+    if src.metadata.zarr_format != 2 or dst.metadata.zarr_format != 2:
+        return None
+    lead = zarr.open_group(vpu_path, mode='r').attrs.get('river_id_lead', 0)
+    metadata = [
+        json.dumps({k: v for k, v in a.metadata.to_dict().items() if k not in ('shape', 'attributes')}, default=str)
+        for a in (src, dst)
+    ]
+    chunk = src.chunks[1]
+    if metadata[0] != metadata[1] or src.shape[0] != dst.shape[0] or offset < lead or (offset - lead) % chunk:
+        return None
+    return (offset - lead) // chunk, lead
+
+
+def copy_vpu_chunks(vpu_path, path, var_name, offset, first_chunk, lead):
+    """
+    Copy the compressed chunk files that lie entirely within the vpu to their renamed keys in the global store. The
+    partial chunks at either edge are decoded and returned like the edges of write_vpu_region.
+    """
+    src = open_variable(vpu_path, var_name, mode='r')
+    separator = src.metadata.dimension_separator
+    n_time_chunks = -(-src.shape[0] // src.chunks[0])
+    chunk = src.chunks[1]
+    end = src.shape[1]
+    head_end, tail_start = chunk_aligned_bounds(lead, end, chunk)
+    for j in range(head_end // chunk, tail_start // chunk):
+        for i in range(n_time_chunks):
+            # chunks that were never written hold only fill values and are left missing in the global store too
+            src_file = os.path.join(vpu_path, var_name, f'{i}{separator}{j}')
+            if os.path.exists(src_file):
+                shutil.copyfile(src_file, os.path.join(path, var_name, f'{i}{separator}{first_chunk + j}'))
+    edges = []
+    if head_end > lead:
+        edges.append((offset, src[:, lead:head_end]))
+    if end > tail_start:
+        edges.append((offset + tail_start - lead, src[:, tail_start:end]))
+    return edges
+
+
+def write_vpu_region(args):
+    """
+    Copy one vpu into its river_id region of the global store. Whole chunks are written directly, or copied without
+    decoding when a chunk copy plan is given. The partial chunks at either edge of the region are shared with the
+    neighboring vpus, so they are returned to the caller to write instead of being written concurrently by two workers.
+    """
+    open_vpu, vpu, path, var_name, offset, chunk, rivers_per_write, vpu_path, copy_plan = args
+    if copy_plan is not None:
+        edges = copy_vpu_chunks(vpu_path, path, var_name, offset, *copy_plan)
+        print(f'Finished copying {vpu}')
+        return edges
+    array = open_variable(path, var_name)
+    with dask.config.set(scheduler='synchronous'), open_vpu(vpu) as ds:
+        source = ds[var_name].transpose('time', 'river_id')
+        start, end = offset, offset + source.shape[1]
+        head_end, tail_start = chunk_aligned_bounds(start, end, chunk)
+        edges = []
+        if head_end > start:
+            edges.append((start, source[:, :head_end - start].values))
+        for a in range(head_end, tail_start, rivers_per_write):
+            b = min(a + rivers_per_write, tail_start)
+            array[:, a:b] = source[:, a - offset:b - offset].values
+        if end > tail_start:
+            edges.append((tail_start, source[:, tail_start - offset:].values))
+    print(f'Finished writing {vpu}')
+    return edges
+
+
+def assemble_global_store(open_vpu, vpus, path, chunks, attrs, n_workers, rivers_per_write, var_name='Q',
+                          vpu_store=None, shards=None) -> None:
+    """
+    Combine vpus along river_id into one store with region writes. open_vpu(vpu) returns a lazily opened dataset with
+    (time, river_id) dims and the same time axis for every vpu. The empty store is created first with the final
+    chunks so every worker writes an independent river_id range and the task graph never grows with the vpu count.
+    rivers_per_write is rounded to a multiple of the river_id chunk (or shard, see create_store) size and bounds the
+    memory of each worker.
+
+    If vpu_store(vpu) gives the path of a per-vpu zarr whose chunks line up with the global store (see
+    chunk_copy_plan), that vpu's chunks are copied byte for byte instead of being decoded and encoded again.
+    """
+    river_ids, offsets, times, var_attrs = read_vpu_layout(open_vpu, vpus, n_workers, var_name)
+    create_store(
+        path,
+        dims=('time', 'river_id'),
+        coords={'time': times, 'river_id': np.concatenate(river_ids)},
+        chunks=chunks,
+        var_name=var_name,
+        attrs=attrs,
+        var_attrs=var_attrs,
+        shards=shards,
+    )
+
+    chunk = write_shape(open_variable(path, var_name, mode='r'))[1]
+    rivers_per_write = max(chunk, rivers_per_write // chunk * chunk)
+    jobs = []
+    for vpu, offset in zip(vpus, offsets):
+        vpu_path = vpu_store(vpu) if vpu_store is not None else None
+        copy_plan = chunk_copy_plan(vpu_path, path, var_name, offset) if vpu_path is not None else None
+        jobs.append((open_vpu, vpu, path, var_name, offset, chunk, rivers_per_write, vpu_path, copy_plan))
+    print(f'{sum(j[-1] is not None for j in jobs)} of {len(jobs)} vpus will be copied chunk by chunk')
+    array = open_variable(path, var_name)
+    with fork.Pool(n_workers) as p:
+        # the partial chunks shared by neighboring vpus are written here, one at a time, as the workers return them
+        for edges in p.imap_unordered(write_vpu_region, jobs):
+            for start, values in edges:
+                array[:, start:start + values.shape[1]] = values
+
+
+def sample_chunks(path, var_name, n_chunks, seed=0) -> list:
+    # the decoded values of up to n_chunks chunks of the store chosen at random, bit rounded by the encoding policy
+    array = open_variable(path, var_name, mode='r')
+    grid = [-(-s // c) for s, c in zip(array.shape, array.chunks)]
+    keepbits = encoding_policy(var_name)['keepbits']
+    rng = np.random.default_rng(seed)
+    samples = []
+    for flat in rng.choice(np.prod(grid), min(n_chunks, np.prod(grid)), replace=False):
+        index = np.unravel_index(flat, grid)
+        values = np.ascontiguousarray(array[tuple(slice(i * c, (i + 1) * c) for i, c in zip(index, array.chunks))])
+        if keepbits is not None and values.dtype.kind == 'f':
+            values = np.asarray(numcodecs.BitRound(keepbits).encode(values)).view(values.dtype).reshape(values.shape)
+        samples.append(values)
+    return samples
+
+
+def codec_trial(path, var_name='Q', n_chunks=8, min_decode_fraction=.5) -> tuple:
+    """
+    Compress sample chunks of a store with each Blosc (cname, clevel) in trial_codecs and print the compression ratio
+    and encode and decode speeds. Chooses the codec with the highest ratio among those that decode at least
+    min_decode_fraction as fast as the fastest, since every reader pays the decode time and the writer pays it once,
+    and saves it to encodings_file as the codec of var_name for the stores created after it. Returns the codec.
+    """
+    samples = sample_chunks(path, var_name, n_chunks)
+    n_bytes = sum(s.nbytes for s in samples)
+    results = []
+    for cname, clevel in trial_codecs:
+        codec = numcodecs.Blosc(cname=cname, clevel=clevel, shuffle=numcodecs.Blosc.AUTOSHUFFLE)
+        start = time.perf_counter()
+        encoded = [codec.encode(s) for s in samples]
+        encode_s = time.perf_counter() - start
+        start = time.perf_counter()
+        for e in encoded:
+            codec.decode(e)
+        decode_s = time.perf_counter() - start
+        ratio = n_bytes / sum(len(e) for e in encoded)
+        results.append((cname, clevel, ratio, n_bytes / 2 ** 20 / encode_s, n_bytes / 2 ** 20 / decode_s))
+
+    print(f'{len(samples)} chunks, {n_bytes / 2 ** 20:.0f} MB, keepbits {encoding_policy(var_name)["keepbits"]}')
+    print(f'{"codec":<12}{"ratio":>8}{"encode MB/s":>14}{"decode MB/s":>14}')
+    for cname, clevel, ratio, encode_speed, decode_speed in results:
+        print(f'{f"{cname} {clevel}":<12}{ratio:>8.2f}{encode_speed:>14.0f}{decode_speed:>14.0f}')
+    fastest = max(r[4] for r in results)
+    best = max((r for r in results if r[4] >= min_decode_fraction * fastest), key=lambda r: r[2])
+    save_codec(var_name, best[:2])
+    return best[0], best[1]
+
+
+if __name__ == '__main__':
+    cname, clevel = codec_trial(sys.argv[1], *sys.argv[2:3])
+    print(f'chosen codec: ({cname!r}, {clevel}), saved to {encodings_file} for the stores created from now on')